@@ -5,23 +5,37 @@ The root of the secure-notes-app. Manages the web application's lifecycle.
 from datetime import timedelta
 import os
 import json
-import sqlite3
+import signal
+import sys
 import logging
-from flask import Flask, render_template, flash, request, redirect, session, url_for, g
+from flask import (
+    Flask,
+    render_template,
+    flash,
+    request,
+    redirect,
+    session,
+    url_for,
+    g,
+    jsonify,
+)
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from werkzeug.security import generate_password_hash, check_password_hash
-from returns.result import Success, Failure
+from returns.result import Result, Success, Failure
 
 from validators import validate_registration, validate_note
-from dal import DAL
+from dal import DAL, PermissionCache, PERMISSION_READ, PERMISSION_EDIT, PERMISSION_OWNER
+from audit import audit_log
+from maintenance import scheduler
+import memprofile
 from seed_db import seed_db, init_db
-
-DbConnection = sqlite3.Connection
+from storage import DbConnection, SqliteBackend, open_backend
 
 app = Flask(__name__)
 # TOEX fully explain this
-app.secret_key = os.urandom(24)  # Secure session cookie
+# App nodes sharing a store must share SECRET_KEY, or sessions only work on one node
+app.secret_key = os.environ.get("SECRET_KEY") or os.urandom(24)  # Secure session cookie
 # TOEX fully explain this
 app.config.update(
     # Limits Cookies to HTTPS traffic only
@@ -43,9 +57,15 @@ limiter = Limiter(
     storage_uri="memory://",
 )
 
+# The most operations a client can send to /api/v1/notes/batch in one request
+MAX_BATCH_SIZE = 1000
+
 # TOEX: explain this in the document
 DUMMY_HASH = generate_password_hash(str(os.urandom(24)))
 
+# Where notes are stored, replaced from the "storage" config section at startup
+storage_backend = open_backend()
+
 
 def get_db() -> DbConnection:
     """
@@ -53,18 +73,47 @@ def get_db() -> DbConnection:
     If not, it creates it.
     """
     if "db" not in g:
-        g.db = sqlite3.connect("database.db")
+        g.db = storage_backend.connect()
     return g.db
 
 
+def get_permission_cache() -> PermissionCache:
+    """
+    Gets the note permission cache for the current request, so the DAL only
+    looks up a user's access to a note once per request.
+    """
+    if "permissions" not in g:
+        g.permissions = {}
+    return g.permissions
+
+
 @app.teardown_appcontext
 def close_db(e=None):
     """
-    Automatically closes the database connection at the end of any request.
+    Automatically releases the database connection at the end of any request.
     """
     db = g.pop("db", None)
     if db is not None:
-        db.close()
+        storage_backend.release(db)
+
+
+@app.before_request
+def track_request_start():
+    """
+    Lets the maintenance scheduler know a request is being handled.
+    """
+    g.tracked_request = True
+    scheduler.request_started()
+
+
+@app.teardown_request
+def track_request_end(e=None):
+    """
+    Lets the maintenance scheduler know a request has finished.
+    """
+    # Skip requests rejected before track_request_start ran, e.g. by the rate limiter
+    if g.pop("tracked_request", False):
+        scheduler.request_finished()
 
 
 @app.route("/register", methods=["GET", "POST"])
@@ -87,14 +136,17 @@ def register():
         validation_result = validate_registration(username, password, password_2)
         if isinstance(validation_result, Failure):
             for fail in validation_result.failure():
-                print(fail)
                 flash(fail, "error")
             return redirect(url_for("register"))
 
         creation_result = DAL.create_user(db_, username, password)
         if isinstance(creation_result, Success):
             flash("Account successfully registered!", "notification")
-            app.logger.info("User %s created.", creation_result.unwrap())
+            audit_log.record(
+                "user.register",
+                user_id=creation_result.unwrap(),
+                ip=request.remote_addr,
+            )
             return redirect(url_for("login"))
         # If creation_result is a failure because there was already a user with that username,
         # let them know.
@@ -134,11 +186,14 @@ def login():
         )
 
         if not check_password_hash(user_hash, request.form["password"]):
+            audit_log.record("user.login_failed", ip=request.remote_addr)
             flash("Error, incorrect username or password.", "error")
             return redirect(url_for("login"))
         # else:
         session["user_id"] = res_user.unwrap()[0]
-        app.logger.info("User %s logged in", res_user.unwrap()[0])
+        audit_log.record(
+            "user.login", user_id=res_user.unwrap()[0], ip=request.remote_addr
+        )
         flash("Login successful.", "notification")
         return redirect(url_for("index"))
 
@@ -153,7 +208,7 @@ def logout():
     """
     logout_id = session["user_id"]
     session.clear()
-    app.logger.info("User %s logged out", logout_id)
+    audit_log.record("user.logout", user_id=logout_id, ip=request.remote_addr)
     flash("You have successfully logged out.", "notification")
     return redirect(url_for("index"))
 
@@ -178,7 +233,17 @@ def notes():
         flash(res_user_notes.failure(), "error")
         return redirect(url_for("index"))
 
-    return render_template("notes.html", notes=res_user_notes.unwrap())
+    res_shared_notes = DAL.get_notes_shared_with_user(db_, user_id)
+    if isinstance(res_shared_notes, Failure):
+        flash(res_shared_notes.failure(), "error")
+        return redirect(url_for("index"))
+
+    return render_template(
+        "notes.html",
+        notes=res_user_notes.unwrap(),
+        shared_notes=res_shared_notes.unwrap(),
+        edit_level=PERMISSION_EDIT,
+    )
 
 
 @app.route("/notes/new", methods=["GET", "POST"])
@@ -202,11 +267,15 @@ def new_note():
             return redirect(url_for("new_note"))
 
         db_ = get_db()
-        res_create_note = DAL.create_note_for_user(db_, user_id, content)
+        res_create_note = DAL.create_note_for_user(
+            db_, user_id, content, cache=get_permission_cache()
+        )
         if isinstance(res_create_note, Failure):
             flash(res_create_note.failure(), "error")
             return redirect(url_for("new_note"))
-        app.logger.info("User %s created note %s", user_id, res_create_note.unwrap())
+        audit_log.record(
+            "note.create", user_id=user_id, note_id=res_create_note.unwrap()
+        )
         flash("Note successfully edited.", "notification")
 
         return redirect(url_for("notes"))
@@ -240,21 +309,34 @@ def edit_note(note_id: int):
             return redirect(url_for("edit_note", note_id=note_id))
 
         # DB access
-        res_edit_note = DAL.edit_note(db_, note_id, user_id, content)
+        res_edit_note = DAL.edit_note(
+            db_, note_id, user_id, content, cache=get_permission_cache()
+        )
         if isinstance(res_edit_note, Failure):
             flash(res_edit_note.failure(), "error")
             return redirect(url_for("edit_note", note_id=note_id))
-        app.logger.info("User %s edited note %s", user_id, note_id)
+        audit_log.record("note.edit", user_id=user_id, note_id=note_id)
         flash("Note successfully edited.", "notification")
         return redirect(url_for("notes"))
 
     # Handle GET
-    res_get_note = DAL.get_note_by_id(db_, note_id, user_id)
+    res_get_note = DAL.get_note_by_id(db_, note_id, user_id, get_permission_cache())
     if isinstance(res_get_note, Failure):
         flash(res_get_note.failure(), "error")
         return redirect(url_for("notes"))
 
-    return render_template("single-note.html", note=res_get_note.unwrap())
+    # Served from the cache filled by get_note_by_id, so no extra query
+    res_level = DAL.get_permission(db_, note_id, user_id, get_permission_cache())
+    if isinstance(res_level, Failure):
+        flash(res_level.failure(), "error")
+        return redirect(url_for("notes"))
+
+    return render_template(
+        "single-note.html",
+        note=res_get_note.unwrap(),
+        can_edit=res_level.unwrap() >= PERMISSION_EDIT,
+        is_owner=res_level.unwrap() == PERMISSION_OWNER,
+    )
 
 
 @app.route("/notes/delete/<int:note_id>", methods=["POST"])
@@ -269,16 +351,396 @@ def delete_note(note_id: int):
 
     db_ = get_db()
 
-    res_delete_note = DAL.delete_note(db_, note_id, user_id)
+    res_delete_note = DAL.delete_note(
+        db_, note_id, user_id, cache=get_permission_cache()
+    )
     if isinstance(res_delete_note, Failure):
         flash(res_delete_note.failure(), "error")
         return redirect(url_for("delete_note", note_id=note_id))
-    app.logger.info("User %s deleted note %s", user_id, note_id)
+    audit_log.record("note.delete", user_id=user_id, note_id=note_id)
     flash("Note successfully edited.", "notification")
 
     return redirect(url_for("notes"))
 
 
+@app.route("/notes/history/<int:note_id>", methods=["GET"])
+def note_history(note_id: int):
+    """
+    Defines the endpoint where users can GET a page of a note's past revisions.
+    """
+    if "user_id" not in session:
+        flash("You must be logged in to view note history.", "error")
+        return redirect(url_for("login"))
+    user_id = session["user_id"]
+
+    page = request.args.get("page", 0, type=int)
+
+    db_ = get_db()
+
+    res_history = DAL.get_note_history(
+        db_, note_id, user_id, page, get_permission_cache()
+    )
+    if isinstance(res_history, Failure):
+        flash(res_history.failure(), "error")
+        return redirect(url_for("notes"))
+    revisions, has_more = res_history.unwrap()
+
+    # Readers can see the history, only editors can restore from it
+    res_level = DAL.get_permission(db_, note_id, user_id, get_permission_cache())
+    if isinstance(res_level, Failure):
+        flash(res_level.failure(), "error")
+        return redirect(url_for("notes"))
+
+    return render_template(
+        "history.html",
+        note_id=note_id,
+        revisions=revisions,
+        page=max(page, 0),
+        has_more=has_more,
+        can_edit=res_level.unwrap() >= PERMISSION_EDIT,
+    )
+
+
+@app.route("/notes/restore/<int:note_id>/<int:revision>", methods=["POST"])
+def restore_note(note_id: int, revision: int):
+    """
+    Defines the endpoint for restoring a note to an earlier revision on POST
+    """
+    if "user_id" not in session:
+        flash("You must be logged in to restore a note.", "error")
+        return redirect(url_for("login"))
+    user_id = session["user_id"]
+
+    db_ = get_db()
+
+    res_restore = DAL.restore_note_revision(
+        db_, note_id, user_id, revision, get_permission_cache()
+    )
+    if isinstance(res_restore, Failure):
+        flash(res_restore.failure(), "error")
+        return redirect(url_for("note_history", note_id=note_id))
+    audit_log.record(
+        "note.restore", user_id=user_id, note_id=note_id, revision=revision
+    )
+    flash("Note successfully restored.", "notification")
+
+    return redirect(url_for("edit_note", note_id=note_id))
+
+
+@app.route("/notes/share/<int:note_id>", methods=["GET", "POST"])
+def share_note(note_id: int):
+    """
+    Defines the endpoint where a note's owner can GET who it is shared with,
+    or POST a username and access level to share it with someone else.
+    """
+    if "user_id" not in session:
+        flash("You must be logged in to share a note.", "error")
+        return redirect(url_for("login"))
+    user_id = session["user_id"]
+
+    db_ = get_db()
+
+    if request.method == "POST":
+        username = request.form["username"].strip()
+        level = PERMISSION_EDIT if request.form.get("level") == "edit" else PERMISSION_READ
+
+        res_share = DAL.share_note(
+            db_, note_id, user_id, username, level, get_permission_cache()
+        )
+        if isinstance(res_share, Failure):
+            flash(res_share.failure(), "error")
+            return redirect(url_for("share_note", note_id=note_id))
+        audit_log.record(
+            "note.share",
+            user_id=user_id,
+            note_id=note_id,
+            shared_with=res_share.unwrap(),
+            level=level,
+        )
+        flash(f"Note shared with {username}.", "notification")
+        return redirect(url_for("share_note", note_id=note_id))
+
+    # Handle GET
+    res_grants = DAL.get_note_grants(db_, note_id, user_id, get_permission_cache())
+    if isinstance(res_grants, Failure):
+        flash(res_grants.failure(), "error")
+        return redirect(url_for("notes"))
+
+    return render_template(
+        "share.html",
+        note_id=note_id,
+        grants=res_grants.unwrap(),
+        edit_level=PERMISSION_EDIT,
+    )
+
+
+@app.route("/notes/unshare/<int:note_id>/<int:shared_user_id>", methods=["POST"])
+def unshare_note(note_id: int, shared_user_id: int):
+    """
+    Defines the endpoint where a note's owner can POST to take away another user's access
+    """
+    if "user_id" not in session:
+        flash("You must be logged in to share a note.", "error")
+        return redirect(url_for("login"))
+    user_id = session["user_id"]
+
+    res_unshare = DAL.unshare_note(
+        get_db(), note_id, user_id, shared_user_id, get_permission_cache()
+    )
+    if isinstance(res_unshare, Failure):
+        flash(res_unshare.failure(), "error")
+        return redirect(url_for("share_note", note_id=note_id))
+    audit_log.record(
+        "note.unshare", user_id=user_id, note_id=note_id, shared_with=shared_user_id
+    )
+    flash("Note is no longer shared with that user.", "notification")
+
+    return redirect(url_for("share_note", note_id=note_id))
+
+
+# JSON API
+# These routes mirror the HTML note routes for scripted clients.
+# They use the same session cookie for auth, and the same validation and DAL calls.
+
+
+def api_error(message: str, status: int):
+    """
+    Builds a JSON error response.
+    """
+    return jsonify({"error": message}), status
+
+
+def api_failure(res: Result):
+    """
+    Turns a DAL Failure into a JSON error response.
+    Database errors are server errors, anything else means the note wasn't found.
+    """
+    message = res.failure()
+    return api_error(message, 500 if "database error" in message else 404)
+
+
+def result_to_json(res: Result) -> dict:
+    """
+    Turns a Result into the per-operation outcome returned by the batch endpoint.
+    """
+    if isinstance(res, Success):
+        return {"ok": True, "value": res.unwrap()}
+    return {"ok": False, "error": res.failure()}
+
+
+def parse_api_operation(item) -> Result[tuple, str]:
+    """
+    Validates one operation sent to the batch endpoint.
+    Returns Success((op, note_id, content)) ready for DAL.apply_note_batch, or Failure(str).
+    """
+    if not isinstance(item, dict):
+        return Failure("Each operation must be a JSON object.")
+
+    op = item.get("op")
+    if op not in ("create", "edit", "delete"):
+        return Failure("op must be one of create, edit or delete.")
+
+    note_id = item.get("id")
+    if op != "create" and (not isinstance(note_id, int) or isinstance(note_id, bool)):
+        return Failure("id must be an integer.")
+
+    content = item.get("content")
+    if op != "delete":
+        if not isinstance(content, str):
+            return Failure("content must be a string.")
+        res_val_note = validate_note(content)
+        if isinstance(res_val_note, Failure):
+            return res_val_note
+
+    return Success((op, note_id, content))
+
+
+def get_api_content() -> Result[str, str]:
+    """
+    Reads and validates the note content from a JSON request body.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("content"), str):
+        return Failure("Request body must be a JSON object with a content string.")
+    content = body["content"]
+    res_val_note = validate_note(content)
+    if isinstance(res_val_note, Failure):
+        return res_val_note
+    return Success(content)
+
+
+@app.route("/api/v1/notes", methods=["GET"])
+def api_list_notes():
+    """
+    Defines the endpoint where users can GET all of their notes as JSON.
+    """
+    if "user_id" not in session:
+        return api_error("You must be logged in to view notes.", 401)
+
+    res_user_notes = DAL.get_notes_for_user(get_db(), session["user_id"])
+    if isinstance(res_user_notes, Failure):
+        return api_failure(res_user_notes)
+
+    return jsonify(
+        {"notes": [{"id": note[0], "content": note[1]} for note in res_user_notes.unwrap()]}
+    )
+
+
+@app.route("/api/v1/notes/shared", methods=["GET"])
+def api_list_shared_notes():
+    """
+    Defines the endpoint where users can GET the notes shared with them as JSON.
+    """
+    if "user_id" not in session:
+        return api_error("You must be logged in to view notes.", 401)
+
+    res_shared_notes = DAL.get_notes_shared_with_user(get_db(), session["user_id"])
+    if isinstance(res_shared_notes, Failure):
+        return api_failure(res_shared_notes)
+
+    return jsonify(
+        {
+            "notes": [
+                {
+                    "id": note[0],
+                    "content": note[1],
+                    "access": "edit" if note[2] >= PERMISSION_EDIT else "read",
+                    "owner": note[3],
+                }
+                for note in res_shared_notes.unwrap()
+            ]
+        }
+    )
+
+
+@app.route("/api/v1/notes/<int:note_id>", methods=["GET"])
+def api_get_note(note_id: int):
+    """
+    Defines the endpoint where users can GET a single note as JSON.
+    """
+    if "user_id" not in session:
+        return api_error("You must be logged in to view notes.", 401)
+
+    res_get_note = DAL.get_note_by_id(
+        get_db(), note_id, session["user_id"], get_permission_cache()
+    )
+    if isinstance(res_get_note, Failure):
+        return api_failure(res_get_note)
+
+    note = res_get_note.unwrap()
+    return jsonify({"id": note[0], "content": note[1]})
+
+
+@app.route("/api/v1/notes", methods=["POST"])
+def api_create_note():
+    """
+    Defines the endpoint where users can POST a JSON note to create it.
+    """
+    if "user_id" not in session:
+        return api_error("You must be logged in to create a note.", 401)
+    user_id = session["user_id"]
+
+    res_content = get_api_content()
+    if isinstance(res_content, Failure):
+        return api_error(res_content.failure(), 400)
+
+    res_create_note = DAL.create_note_for_user(
+        get_db(), user_id, res_content.unwrap(), cache=get_permission_cache()
+    )
+    if isinstance(res_create_note, Failure):
+        return api_failure(res_create_note)
+    audit_log.record("note.create", user_id=user_id, note_id=res_create_note.unwrap())
+
+    return jsonify({"id": res_create_note.unwrap()}), 201
+
+
+@app.route("/api/v1/notes/<int:note_id>", methods=["PUT"])
+def api_edit_note(note_id: int):
+    """
+    Defines the endpoint where users can PUT new JSON content for a note.
+    """
+    if "user_id" not in session:
+        return api_error("You must be logged in to edit a note.", 401)
+    user_id = session["user_id"]
+
+    res_content = get_api_content()
+    if isinstance(res_content, Failure):
+        return api_error(res_content.failure(), 400)
+
+    res_edit_note = DAL.edit_note(
+        get_db(), note_id, user_id, res_content.unwrap(), cache=get_permission_cache()
+    )
+    if isinstance(res_edit_note, Failure):
+        return api_failure(res_edit_note)
+    audit_log.record("note.edit", user_id=user_id, note_id=note_id)
+
+    return jsonify({"id": note_id})
+
+
+@app.route("/api/v1/notes/<int:note_id>", methods=["DELETE"])
+def api_delete_note(note_id: int):
+    """
+    Defines the endpoint for deleting the note with the given note_id.
+    """
+    if "user_id" not in session:
+        return api_error("You must be logged in to delete a note.", 401)
+    user_id = session["user_id"]
+
+    res_delete_note = DAL.delete_note(
+        get_db(), note_id, user_id, cache=get_permission_cache()
+    )
+    if isinstance(res_delete_note, Failure):
+        return api_failure(res_delete_note)
+    audit_log.record("note.delete", user_id=user_id, note_id=note_id)
+
+    return jsonify({"id": note_id})
+
+
+@app.route("/api/v1/notes/batch", methods=["POST"])
+def api_note_batch():
+    """
+    Defines the endpoint where users can POST many note operations at once:
+        {"operations": [{"op": "create", "content": "..."},
+                        {"op": "edit", "id": 1, "content": "..."},
+                        {"op": "delete", "id": 2}]}
+    All valid operations are applied in one transaction. The response has one
+    {"ok": ..., "value"/"error": ...} outcome per operation, in order.
+    """
+    if "user_id" not in session:
+        return api_error("You must be logged in to change notes.", 401)
+    user_id = session["user_id"]
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("operations"), list):
+        return api_error("Request body must be a JSON object with an operations list.", 400)
+    operations = body["operations"]
+    if len(operations) > MAX_BATCH_SIZE:
+        return api_error(f"A batch cannot have more than {MAX_BATCH_SIZE} operations.", 400)
+
+    # Operations that fail validation get their outcome now and never reach the DAL
+    results: list[Result] = []
+    valid = []
+    for i, item in enumerate(operations):
+        res_op = parse_api_operation(item)
+        results.append(res_op)
+        if isinstance(res_op, Success):
+            valid.append((i, res_op.unwrap()))
+
+    res_batch = DAL.apply_note_batch(
+        get_db(), user_id, [op for _, op in valid], get_permission_cache()
+    )
+    if isinstance(res_batch, Failure):
+        return api_error(res_batch.failure(), 500)
+
+    for (i, (op, note_id, _)), res in zip(valid, res_batch.unwrap()):
+        results[i] = res
+        if isinstance(res, Success):
+            note_id = res.unwrap() if op == "create" else note_id
+            audit_log.record(f"note.{op}", user_id=user_id, note_id=note_id)
+
+    return jsonify({"results": [result_to_json(res) for res in results]})
+
+
 @app.route("/", methods=["GET"])
 def index():
     """
@@ -293,12 +755,40 @@ if __name__ == "__main__":
     host = config["server"]["host"]
     port = config["server"]["port"]
     debug = config["debug_bool"]
-
-    with app.app_context():
-        db = get_db()
-        init_db(db)
-        # Only seed db values if the app is running in debug mode
-        if debug:
-            seed_db(db)
-
-    app.run(host=host, port=port, debug=debug, ssl_context=("cert.pem", "key.pem"))
+    # In debug mode the reloader serves requests from a child process, and kills
+    # it outright when the parent gets SIGTERM, losing its queued audit events.
+    # Code never changes inside a container, so the image turns it off.
+    use_reloader = debug and os.environ.get("FLASK_RUN_RELOAD", "true") != "false"
+
+    audit_log.start(config.get("audit"))
+    # docker stop sends SIGTERM, exit normally so atexit flushes queued audit events.
+    # Without the reloader this is the process that queued them.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    memprofile.install(config.get("memory_profiling"))
+
+    storage_backend = open_backend(config.get("storage"))
+
+    # With a remote backend, the storage daemon sets up, seeds and maintains the
+    # database, and this process stays stateless.
+    if isinstance(storage_backend, SqliteBackend):
+        with app.app_context():
+            db = get_db()
+            init_db(db)
+            # Only seed db values if the app is running in debug mode
+            if debug:
+                seed_db(db)
+
+        # The reloader runs this file twice, only schedule maintenance in the
+        # child process that actually serves requests.
+        if not use_reloader or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            scheduler.start(
+                storage_backend.path, config.get("maintenance"), config.get("backup")
+            )
+
+    app.run(
+        host=host,
+        port=port,
+        debug=debug,
+        use_reloader=use_reloader,
+        ssl_context=("cert.pem", "key.pem"),
+    )
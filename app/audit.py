@@ -0,0 +1,206 @@
+"""
+Structured audit logging that stays off the request path.
+
+Request handlers call audit_log.record(), which only puts a dict on a bounded
+in-memory queue. A background thread serializes queued events to JSON lines and
+writes them to a rotating file in batches.
+"""
+
+import atexit
+import json
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+# Put on the queue by close() to tell the writer thread to finish
+_STOP = object()
+
+
+class AuditLog:
+    """
+    A bounded queue of audit events drained by a background writer thread.
+
+    Backpressure: when the queue is full, record() waits up to block_timeout
+    seconds for space, then drops the event. Dropped events are counted and the
+    count is written to the log as an "audit.dropped" event.
+
+    Sampling: sample_rates maps event names to the fraction of those events kept,
+    so high-volume events can be thinned out. Unlisted events are always kept.
+    """
+
+    def __init__(self):
+        self._queue: queue.Queue | None = None
+        self._thread: threading.Thread | None = None
+        self._file = None
+        self._lock = threading.Lock()
+        self._dropped = 0
+        self._size = 0
+        self.path = "audit.log"
+        self.max_bytes = 10 * 1024 * 1024
+        self.backup_count = 5
+        self.batch_size = 500
+        self.block_timeout = 0.0
+        self.sample_rates: dict[str, float] = {}
+
+    def start(self, config: dict | None = None) -> None:
+        """
+        Opens the log file and starts the writer thread.
+        config is the "audit" section of config.json, every key is optional.
+        """
+        if self._thread is not None:
+            return
+        config = config or {}
+        self.path = config.get("path", self.path)
+        self.max_bytes = config.get("max_bytes", self.max_bytes)
+        self.backup_count = config.get("backup_count", self.backup_count)
+        self.batch_size = config.get("batch_size", self.batch_size)
+        self.block_timeout = config.get("block_timeout", self.block_timeout)
+        self.sample_rates = config.get("sample_rates", self.sample_rates)
+
+        self._open()
+        self._queue = queue.Queue(maxsize=config.get("queue_size", 10000))
+        self._thread = threading.Thread(
+            target=self._run, name="audit-writer", daemon=True
+        )
+        self._thread.start()
+        # Flush whatever is still queued when the process exits
+        atexit.register(self.close)
+
+    def record(self, event: str, **fields) -> None:
+        """
+        Queues an audit event. Never blocks for longer than block_timeout,
+        and does nothing if the log has not been started.
+        """
+        q = self._queue
+        if q is None:
+            return
+
+        rate = self.sample_rates.get(event, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            return
+
+        item = {"event": event, "ts": time.time(), **fields}
+        try:
+            if self.block_timeout > 0:
+                q.put(item, timeout=self.block_timeout)
+            else:
+                q.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+
+    def close(self, timeout: float = 5.0) -> None:
+        """
+        Writes out every queued event and stops the writer thread.
+        """
+        q, thread = self._queue, self._thread
+        if q is None or thread is None:
+            return
+        # Stop accepting new events before asking the writer to finish
+        self._queue = None
+        self._thread = None
+        try:
+            q.put(_STOP, timeout=timeout)
+        except queue.Full:
+            # The writer is stuck, don't let it hold up shutdown
+            return
+        thread.join(timeout)
+
+    def _run(self) -> None:
+        """
+        The writer thread, drains the queue in batches until close() is called.
+        """
+        q = self._queue
+        stopping = False
+        while not stopping:
+            batch = [q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stopping = True
+                batch = [event for event in batch if event is not _STOP]
+            count = len(batch)
+            try:
+                self._write(batch)
+            except (OSError, ValueError):
+                # A full disk or failed rotation must not kill the writer, the
+                # batch is counted as dropped and the next one tries again on a
+                # freshly opened file, in case the old handle is what broke
+                with self._lock:
+                    self._dropped += count
+                self._close_file()
+        self._close_file()
+
+    def _write(self, batch: list[dict]) -> None:
+        """
+        Serializes a batch of events and appends them to the log file.
+        """
+        with self._lock:
+            dropped = self._dropped
+        if dropped:
+            batch.append({"event": "audit.dropped", "ts": time.time(), "count": dropped})
+        if not batch:
+            return
+
+        lines = []
+        for event in batch:
+            event["ts"] = datetime.fromtimestamp(event["ts"], timezone.utc).isoformat()
+            lines.append(json.dumps(event, default=str, separators=(",", ":")))
+        data = "\n".join(lines) + "\n"
+
+        if self._file is None:
+            self._open()
+        elif self._size >= self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        with self._lock:
+            self._dropped -= dropped
+        self._size += len(data.encode())
+
+    def _open(self) -> None:
+        """
+        Opens the log file for appending.
+        """
+        # pylint: disable=consider-using-with
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+
+    def _close_file(self) -> None:
+        """
+        Closes the log file, if it is open. The next write reopens it.
+        """
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+        except (OSError, ValueError):
+            # Closing flushes, which fails the same way the last write did
+            pass
+        self._file = None
+
+    def _rotate(self) -> None:
+        """
+        Moves audit.log to audit.log.1, audit.log.1 to audit.log.2 and so on,
+        deleting the oldest file once there are backup_count of them.
+        """
+        self._file.close()
+        self._file = None
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+
+audit_log = AuditLog()
@@ -0,0 +1,291 @@
+"""
+Online backups of the notes database using SQLite's backup API.
+
+Backups are copied a few pages at a time with a pause between steps, so the
+copy never holds a lock on the live database for long. Each backup is gzipped,
+written next to a sha256 checksum file, and old backups are pruned to keep.
+
+Usage, from the project root:
+    python app/backup.py create
+    python app/backup.py list
+    python app/backup.py restore [path] [--at 2025-01-31T12:00:00]
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from returns.result import Result, Success, Failure
+
+DbConnection = sqlite3.Connection
+
+BACKUP_PREFIX = "backup-"
+BACKUP_SUFFIX = ".db.gz"
+# Microseconds, so backups taken in the same second don't overwrite each other
+TIMESTAMP_FORMAT = "%Y%m%dT%H%M%S%fZ"
+# Backups taken before that are still listed, pruned and restorable
+LEGACY_TIMESTAMP_FORMATS = ("%Y%m%dT%H%M%SZ",)
+DEFAULTS = {
+    "dir": "backups",
+    "keep": 7,
+    "pages": 256,
+    "pause": 0.01,
+    "max_restarts": 3,
+}
+
+
+class _TooManyRestarts(Exception):
+    """Raised from the progress callback to abandon an incremental copy."""
+
+
+def _setting(config: dict | None, key: str):
+    """Reads a setting from the "backup" config section, falling back to DEFAULTS."""
+    return (config or {}).get(key, DEFAULTS[key])
+
+
+def _sha256(path: str) -> str:
+    """Hashes a file in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _copy_online(src: DbConnection, dst: DbConnection, config: dict | None) -> None:
+    """
+    Copies src into dst in batches of pages, sleeping between batches.
+
+    SQLite restarts a backup from scratch whenever another connection writes to
+    the source mid-copy. After max_restarts, the rest is copied in a single step
+    instead. In WAL mode that step only reads a snapshot, so writers still aren't blocked.
+    """
+    pause = _setting(config, "pause")
+    max_restarts = _setting(config, "max_restarts")
+    last_remaining = None
+    restarts = 0
+
+    def progress(_status, remaining, _total):
+        nonlocal last_remaining, restarts
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > max_restarts:
+                raise _TooManyRestarts()
+        last_remaining = remaining
+        time.sleep(pause)
+
+    try:
+        src.backup(dst, pages=_setting(config, "pages"), progress=progress)
+    except _TooManyRestarts:
+        src.backup(dst, pages=-1)
+
+
+def list_backups(config: dict | None = None) -> list[tuple[datetime, str]]:
+    """
+    Lists the backups in the backup directory as (taken_at, path), oldest first.
+    """
+    backup_dir = _setting(config, "dir")
+    if not os.path.isdir(backup_dir):
+        return []
+
+    backups = []
+    for name in os.listdir(backup_dir):
+        if not (name.startswith(BACKUP_PREFIX) and name.endswith(BACKUP_SUFFIX)):
+            continue
+        taken_at = _parse_stamp(name[len(BACKUP_PREFIX) : -len(BACKUP_SUFFIX)])
+        if taken_at is None:
+            continue
+        backups.append(
+            (taken_at.replace(tzinfo=timezone.utc), os.path.join(backup_dir, name))
+        )
+    return sorted(backups)
+
+
+def _parse_stamp(stamp: str) -> datetime | None:
+    """Parses the timestamp in a backup's file name, or returns None if it isn't one."""
+    for fmt in (TIMESTAMP_FORMAT, *LEGACY_TIMESTAMP_FORMATS):
+        try:
+            return datetime.strptime(stamp, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def prune_backups(config: dict | None = None) -> int:
+    """
+    Deletes all but the newest keep backups.
+    Returns the number of backups deleted.
+    """
+    backups = list_backups(config)
+    stale = backups[: max(len(backups) - _setting(config, "keep"), 0)]
+    for _, path in stale:
+        os.remove(path)
+        if os.path.exists(path + ".sha256"):
+            os.remove(path + ".sha256")
+    return len(stale)
+
+
+def create_backup(src: DbConnection, config: dict | None = None) -> Result[str, str]:
+    """
+    Takes a compressed, checksummed backup of the database open on src,
+    then prunes old backups.
+    Returns Success(path_of_backup) or Failure(str).
+    """
+    backup_dir = _setting(config, "dir")
+    stamp = datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT)
+    path = os.path.join(backup_dir, f"{BACKUP_PREFIX}{stamp}{BACKUP_SUFFIX}")
+
+    raw_path = None
+    try:
+        os.makedirs(backup_dir, exist_ok=True)
+        fd, raw_path = tempfile.mkstemp(dir=backup_dir, suffix=".db")
+        os.close(fd)
+        dst = sqlite3.connect(raw_path)
+        try:
+            _copy_online(src, dst, config)
+        finally:
+            dst.close()
+
+        with open(raw_path, "rb") as raw, gzip.open(path + ".tmp", "wb") as out:
+            shutil.copyfileobj(raw, out, 1024 * 1024)
+        os.replace(path + ".tmp", path)
+
+        with open(path + ".sha256", "w", encoding="utf-8") as f:
+            f.write(f"{_sha256(path)}  {os.path.basename(path)}\n")
+    except (sqlite3.Error, OSError) as e:
+        return Failure(f"Could not back up the database: {e}")
+    finally:
+        for leftover in (raw_path, path + ".tmp"):
+            if leftover is not None and os.path.exists(leftover):
+                os.remove(leftover)
+
+    try:
+        prune_backups(config)
+    except OSError as e:
+        return Failure(f"Backed up to {path}, but could not prune old backups: {e}")
+    return Success(path)
+
+
+def verify_backup(path: str) -> Result[None, str]:
+    """
+    Checks a backup against its sha256 file.
+    """
+    try:
+        with open(path + ".sha256", "r", encoding="utf-8") as f:
+            expected = f.read().split()[0]
+        if _sha256(path) != expected:
+            return Failure(f"Checksum mismatch, {path} is corrupt.")
+        return Success(None)
+    except (OSError, IndexError) as e:
+        return Failure(f"Could not verify {path}: {e}")
+
+
+def restore_backup(db_path: str, path: str) -> Result[None, str]:
+    """
+    Replaces the contents of the database at db_path with a backup.
+    The backup is checksummed and integrity checked before anything is overwritten,
+    and it is copied in through the backup API, so the restore is safe while the app is running.
+    """
+    res_verify = verify_backup(path)
+    if isinstance(res_verify, Failure):
+        return res_verify
+
+    raw_path = None
+    try:
+        fd, raw_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        with gzip.open(path, "rb") as packed, open(raw_path, "wb") as raw:
+            shutil.copyfileobj(packed, raw, 1024 * 1024)
+
+        src = sqlite3.connect(raw_path)
+        try:
+            if src.execute("PRAGMA integrity_check").fetchone()[0] != "ok":
+                return Failure(f"{path} failed its integrity check.")
+            dst = sqlite3.connect(db_path)
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+        return Success(None)
+    except (sqlite3.Error, OSError, EOFError) as e:
+        return Failure(f"Could not restore {path}: {e}")
+    finally:
+        if raw_path is not None:
+            os.remove(raw_path)
+
+
+def pick_backup(config: dict | None, at: datetime | None) -> Result[str, str]:
+    """
+    Picks the newest backup taken at or before at, or the newest overall.
+    """
+    backups = list_backups(config)
+    if at is not None:
+        backups = [b for b in backups if b[0] <= at]
+    if not backups:
+        return Failure("No backup was found.")
+    return Success(backups[-1][1])
+
+
+def _utc_time(value: str) -> datetime:
+    """Parses an ISO time for --at, taking it as UTC unless it has a timezone."""
+    try:
+        at = datetime.fromisoformat(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"not an ISO time: {value!r}") from e
+    return at if at.tzinfo else at.replace(tzinfo=timezone.utc)
+
+
+def main() -> None:
+    """The backup command line."""
+    parser = argparse.ArgumentParser(description="Back up or restore the notes database")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("create", help="take a backup now")
+    commands.add_parser("list", help="list backups, oldest first")
+    restore = commands.add_parser("restore", help="restore a backup")
+    restore.add_argument("path", nargs="?", help="backup file, defaults to the newest")
+    restore.add_argument(
+        "--at",
+        type=_utc_time,
+        help="restore the newest backup taken at or before this UTC ISO time",
+    )
+    args = parser.parse_args()
+
+    with open("config.json", "r", encoding="utf-8") as f:
+        full_config = json.load(f)
+    config = full_config.get("backup")
+    db_path = full_config.get("storage", {}).get("path", "database.db")
+
+    if args.command == "list":
+        for taken_at, path in list_backups(config):
+            print(f"{taken_at.isoformat()}  {path}")
+        return
+
+    if args.command == "create":
+        db_ = sqlite3.connect(db_path)
+        res = create_backup(db_, config)
+        db_.close()
+    else:
+        if args.path:
+            res = Success(args.path)
+        else:
+            res = pick_backup(config, args.at)
+        if isinstance(res, Success):
+            path = res.unwrap()
+            res = restore_backup(db_path, path).map(lambda _: path)
+
+    if isinstance(res, Failure):
+        sys.exit(res.failure())
+    print(f"{args.command}: {res.unwrap()}")
+
+
+if __name__ == "__main__":
+    main()
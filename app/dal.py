@@ -6,12 +6,30 @@ import sqlite3
 from typing import Tuple
 from werkzeug.security import check_password_hash, generate_password_hash
 from returns.result import Result, Success, Failure
+from audit import audit_log
+from revisions import (
+    HISTORY_PAGE_SIZE,
+    SNAPSHOT_INTERVAL,
+    make_delta,
+    rebuild,
+)
+from storage import DbConnection
 
-DbConnection = sqlite3.Connection
+# Maps (note_id, user_id) to a permission level, see DAL._fetch_note
+PermissionCache = dict[Tuple[int, int], int]
+
+# Permission levels a user can hold on a note, each includes the ones below it
+PERMISSION_NONE = 0
+PERMISSION_READ = 1
+PERMISSION_EDIT = 2
+PERMISSION_OWNER = 3
 
 
 class DAL:
-    """A namespace for all sqlite3 database operations"""
+    """
+    A namespace for all database operations.
+    Works on any DbConnection, a local sqlite3 connection or the storage daemon's.
+    """
 
     @staticmethod
     def find_user_by_id(db_: DbConnection, user_id: int) -> Result[Tuple, str]:
@@ -28,7 +46,7 @@ class DAL:
                 return Success(user)
             return Failure("User not found.")
         except sqlite3.Error as e:
-            print(f"Database error in find_user: {e}")
+            audit_log.record("db.error", operation="find_user", error=str(e))
             return Failure("A database error occurred.")
 
     @staticmethod
@@ -46,7 +64,7 @@ class DAL:
                 return Success(user)
             return Failure("User not found.")
         except sqlite3.Error as e:
-            print(f"Database error in find_user: {e}")
+            audit_log.record("db.error", operation="find_user", error=str(e))
             return Failure("A database error occurred.")
 
     @staticmethod
@@ -71,7 +89,7 @@ class DAL:
             # error occurs if the username is not unique
             return Failure("This username is already taken.")
         except sqlite3.Error as e:
-            print(f"Database error in create_user: {e}")
+            audit_log.record("db.error", operation="create_user", error=str(e))
             return Failure("A database error occurred.")
 
     @staticmethod
@@ -112,22 +130,22 @@ class DAL:
             db_.commit()
             return Success(None)
         except sqlite3.Error as e:
-            print(f"database error in update_password: {e}")
+            audit_log.record("db.error", operation="update_password", error=str(e))
             return Failure("could not update password due to a database error.")
 
     @staticmethod
     def get_note_by_id(
-        db_: DbConnection, note_id: int, user_id: int
+        db_: DbConnection,
+        note_id: int,
+        user_id: int,
+        cache: PermissionCache | None = None,
     ) -> Result[Tuple, str]:
         """
-        Retrieves a note by id
+        Retrieves a note by id, if the user owns it or it has been shared with them.
         Returns Success(note) or Failure.
         """
         try:
-            note = db_.execute(
-                "SELECT id, content FROM notes WHERE id = ? AND user_id = ?",
-                (note_id, user_id),
-            ).fetchone()
+            note = DAL._fetch_note(db_, note_id, user_id, PERMISSION_READ, cache)
 
             if note:
                 return Success(note)
@@ -135,7 +153,7 @@ class DAL:
                 "No note was found with the given id, created by the given user."
             )
         except sqlite3.Error as e:
-            print(f"Database error in get_note_by_id: {e}")
+            audit_log.record("db.error", operation="get_note_by_id", error=str(e))
             return Failure("Could not retrieve note due to a database error.")
 
     @staticmethod
@@ -152,15 +170,214 @@ class DAL:
             # Some users will have no notes when they open the /notes page
             return Success(notes)
         except sqlite3.Error as e:
-            print(f"Database error in get_notes_for_user: {e}")
+            audit_log.record("db.error", operation="get_notes_for_user", error=str(e))
             return Failure("Could not retrieve notes due to a database error.")
 
+    @staticmethod
+    def _fetch_note(
+        db_: DbConnection,
+        note_id: int,
+        user_id: int,
+        min_level: int,
+        cache: PermissionCache | None,
+    ) -> Tuple | None:
+        """
+        Returns the (id, content) of a note if the user holds at least min_level on it.
+        The permission check and the fetch are a single join on the permission table's
+        primary key. Levels are remembered in cache, so later checks in the same
+        request go straight to the note.
+        """
+        key = (note_id, user_id)
+        if cache is not None and key in cache:
+            if cache[key] < min_level:
+                return None
+            return db_.execute(
+                "SELECT id, content FROM notes WHERE id = ?", (note_id,)
+            ).fetchone()
+
+        row = db_.execute(
+            """
+            SELECT n.id, n.content, p.level
+            FROM note_permissions p
+            JOIN notes n ON n.id = p.note_id
+            WHERE p.user_id = ? AND p.note_id = ?
+            """,
+            (user_id, note_id),
+        ).fetchone()
+        if cache is not None:
+            cache[key] = row[2] if row else PERMISSION_NONE
+        if not row or row[2] < min_level:
+            return None
+        return row[:2]
+
+    @staticmethod
+    def get_permission(
+        db_: DbConnection,
+        note_id: int,
+        user_id: int,
+        cache: PermissionCache | None = None,
+    ) -> Result[int, str]:
+        """
+        Finds the permission level a user holds on a note.
+        Returns Success(level), PERMISSION_NONE if they have no access, or Failure.
+        """
+        try:
+            if cache is not None and (note_id, user_id) in cache:
+                return Success(cache[(note_id, user_id)])
+            row = db_.execute(
+                "SELECT level FROM note_permissions WHERE user_id = ? AND note_id = ?",
+                (user_id, note_id),
+            ).fetchone()
+            level = row[0] if row else PERMISSION_NONE
+            if cache is not None:
+                cache[(note_id, user_id)] = level
+            return Success(level)
+        except sqlite3.Error as e:
+            audit_log.record("db.error", operation="get_permission", error=str(e))
+            return Failure("Could not check note permissions due to a database error.")
+
+    @staticmethod
+    def get_notes_shared_with_user(
+        db_: DbConnection, user_id: int
+    ) -> Result[list[Tuple], str]:
+        """
+        Retrieves the notes other users have shared with a user.
+        Returns Success(list of (note_id, content, level, owner_username)) or Failure.
+        """
+        try:
+            notes = db_.execute(
+                """
+                SELECT n.id, n.content, p.level, u.username
+                FROM note_permissions p
+                JOIN notes n ON n.id = p.note_id
+                JOIN users u ON u.id = n.user_id
+                WHERE p.user_id = ? AND p.level < ?
+                """,
+                (user_id, PERMISSION_OWNER),
+            ).fetchall()
+            return Success(notes)
+        except sqlite3.Error as e:
+            audit_log.record(
+                "db.error", operation="get_notes_shared_with_user", error=str(e)
+            )
+            return Failure("Could not retrieve shared notes due to a database error.")
+
+    @staticmethod
+    def get_note_grants(
+        db_: DbConnection,
+        note_id: int,
+        owner_id: int,
+        cache: PermissionCache | None = None,
+    ) -> Result[list[Tuple], str]:
+        """
+        Lists who a note has been shared with. Only the note's owner can see this.
+        Returns Success(list of (user_id, username, level)) or Failure.
+        """
+        try:
+            if not DAL._fetch_note(db_, note_id, owner_id, PERMISSION_OWNER, cache):
+                return Failure("You do not have a note with the given id.")
+            grants = db_.execute(
+                """
+                SELECT u.id, u.username, p.level
+                FROM note_permissions p
+                JOIN users u ON u.id = p.user_id
+                WHERE p.note_id = ? AND p.level < ?
+                ORDER BY u.username
+                """,
+                (note_id, PERMISSION_OWNER),
+            ).fetchall()
+            return Success(grants)
+        except sqlite3.Error as e:
+            audit_log.record("db.error", operation="get_note_grants", error=str(e))
+            return Failure("Could not retrieve note sharing due to a database error.")
+
+    @staticmethod
+    def share_note(
+        db_: DbConnection,
+        note_id: int,
+        owner_id: int,
+        username: str,
+        level: int,
+        cache: PermissionCache | None = None,
+    ) -> Result[int, str]:
+        """
+        Gives another user read or edit access to a note, replacing any access they had.
+        Only the note's owner can do this.
+        Returns Success(user_id of the user it was shared with) or Failure.
+        """
+        if level not in (PERMISSION_READ, PERMISSION_EDIT):
+            return Failure("Notes can only be shared for reading or editing.")
+        try:
+            if not DAL._fetch_note(db_, note_id, owner_id, PERMISSION_OWNER, cache):
+                return Failure("You do not have a note with the given id.")
+
+            user = db_.execute(
+                "SELECT id FROM users WHERE username = ?", (username,)
+            ).fetchone()
+            if not user:
+                return Failure("User not found.")
+            if user[0] == owner_id:
+                return Failure("You cannot share a note with yourself.")
+
+            db_.execute(
+                """
+                INSERT INTO note_permissions (note_id, user_id, level) VALUES (?, ?, ?)
+                ON CONFLICT (user_id, note_id) DO UPDATE SET level = excluded.level
+                """,
+                (note_id, user[0], level),
+            )
+            db_.commit()
+            if cache is not None:
+                cache[(note_id, user[0])] = level
+            return Success(user[0])
+        except sqlite3.Error as e:
+            audit_log.record("db.error", operation="share_note", error=str(e))
+            return Failure("Could not share note due to a database error.")
+
+    @staticmethod
+    def unshare_note(
+        db_: DbConnection,
+        note_id: int,
+        owner_id: int,
+        user_id: int,
+        cache: PermissionCache | None = None,
+    ) -> Result[None, str]:
+        """
+        Takes away another user's access to a note. Only the note's owner can do this.
+        Returns Success() or Failure.
+        """
+        try:
+            if not DAL._fetch_note(db_, note_id, owner_id, PERMISSION_OWNER, cache):
+                return Failure("You do not have a note with the given id.")
+
+            cursor = db_.execute(
+                """
+                DELETE FROM note_permissions
+                WHERE user_id = ? AND note_id = ? AND level < ?
+                """,
+                (user_id, note_id, PERMISSION_OWNER),
+            )
+            db_.commit()
+            if cursor.rowcount == 0:
+                return Failure("That note is not shared with that user.")
+            if cache is not None:
+                cache[(note_id, user_id)] = PERMISSION_NONE
+            return Success(None)
+        except sqlite3.Error as e:
+            audit_log.record("db.error", operation="unshare_note", error=str(e))
+            return Failure("Could not unshare note due to a database error.")
+
     @staticmethod
     def create_note_for_user(
-        db_: DbConnection, user_id: int, content: str
+        db_: DbConnection,
+        user_id: int,
+        content: str,
+        commit: bool = True,
+        cache: PermissionCache | None = None,
     ) -> Result[int, str]:
         """
         Creates a new note for a given user.
+        Pass commit=False to leave the change in the caller's transaction.
         Returns Success() or Failure.
         """
         try:
@@ -171,67 +388,366 @@ class DAL:
                 "INSERT INTO notes (user_id, content) VALUES (?, ?)",
                 (user_id, content),
             )
-            db_.commit()
+            db_.execute(
+                "INSERT INTO note_permissions (note_id, user_id, level) VALUES (?, ?, ?)",
+                (cursor.lastrowid, user_id, PERMISSION_OWNER),
+            )
+            DAL._append_revision(db_, cursor.lastrowid, None, content)
+            if cache is not None:
+                cache[(cursor.lastrowid, user_id)] = PERMISSION_OWNER
+            if commit:
+                db_.commit()
             # Return the id of the created note for logging
             if cursor.lastrowid:
                 return Success(cursor.lastrowid)
             return Failure("An unknown error occurred.")
         except sqlite3.Error as e:
-            print(f"Database error in create_note_for_user: {e}")
+            audit_log.record("db.error", operation="create_note_for_user", error=str(e))
             return Failure("Could not save note due to a database error.")
 
     @staticmethod
     def edit_note(
-        db_: DbConnection, note_id: int, user_id: int, new_content: str
+        db_: DbConnection,
+        note_id: int,
+        user_id: int,
+        new_content: str,
+        commit: bool = True,
+        cache: PermissionCache | None = None,
     ) -> Result[None, str]:
         """
-        updates a note by note_id
+        updates a note by note_id, if the user owns it or has been given edit access
+        Pass commit=False to leave the change in the caller's transaction.
         returns result.success() or result.error.
         """
         try:
             if not new_content:
                 return Failure("note content cannot be empty.")
 
-            cursor = db_.execute(
-                """
-                UPDATE notes 
-                SET content = ?
-                WHERE id = ?
-                AND user_id = ?
-                """,
-                (
-                    new_content,
-                    note_id,
-                    user_id,
-                ),
-            )
-            db_.commit()
+            if commit:
+                # Take the write lock before reading, so a concurrent edit can't change
+                # the note between this read and the revision saved against it
+                DAL._begin_write(db_)
 
-            if cursor.rowcount == 0:
+            note = DAL._fetch_note(db_, note_id, user_id, PERMISSION_EDIT, cache)
+
+            if not note:
                 # The user has not notes with that id.
-                return Failure("You do not have a note with the given id.")
-            return Success(None)
+                res = Failure("You do not have a note with the given id.")
+            elif note[1] == new_content:
+                # Saving unchanged content would only add an empty revision
+                res = Success(None)
+            else:
+                DAL._append_revision(db_, note_id, note[1], new_content)
+                db_.execute(
+                    """
+                    UPDATE notes 
+                    SET content = ?
+                    WHERE id = ?
+                    """,
+                    (
+                        new_content,
+                        note_id,
+                    ),
+                )
+                res = Success(None)
+            if commit:
+                # Also ends the transaction when nothing was written, releasing the lock
+                db_.commit()
+            return res
         except sqlite3.Error as e:
-            print(f"Database error in edit_note: {e}")
+            audit_log.record("db.error", operation="edit_note", error=str(e))
             return Failure("Could not update note due to a database error.")
 
     @staticmethod
-    def delete_note(db_: DbConnection, note_id: int, user_id: str) -> Result[None, str]:
+    def delete_note(
+        db_: DbConnection,
+        note_id: int,
+        user_id: str,
+        commit: bool = True,
+        cache: PermissionCache | None = None,
+    ) -> Result[None, str]:
         """
-        Delete a note by id
+        Delete a note by id, only its owner can do this
+        Pass commit=False to leave the change in the caller's transaction.
         Returns Success() or Failure.
         """
         try:
-            cursor = db_.execute(
-                "DELETE FROM notes WHERE id = ? AND user_id = ?",
-                (note_id, user_id),
-            )
-            db_.commit()
-
-            if cursor.rowcount == 0:
+            if not DAL._fetch_note(db_, note_id, user_id, PERMISSION_OWNER, cache):
                 # No note was found with that id
                 return Failure("You do not have a note with the given id.")
+
+            db_.execute("DELETE FROM notes WHERE id = ?", (note_id,))
+            db_.execute("DELETE FROM note_permissions WHERE note_id = ?", (note_id,))
+            db_.execute("DELETE FROM note_revisions WHERE note_id = ?", (note_id,))
+            if cache is not None:
+                cache[(note_id, user_id)] = PERMISSION_NONE
+            if commit:
+                db_.commit()
             return Success(None)
         except sqlite3.Error as e:
-            print(f"Database error in delete_note: {e}")
+            audit_log.record("db.error", operation="delete_note", error=str(e))
             return Failure("Could not delete note due to a database error.")
+
+    @staticmethod
+    def apply_note_batch(
+        db_: DbConnection,
+        user_id: int,
+        operations: list[Tuple],
+        cache: PermissionCache | None = None,
+    ) -> Result[list[Result], str]:
+        """
+        Applies a batch of note operations for a user in a single transaction.
+        Each operation is ("create", None, content), ("edit", note_id, content)
+        or ("delete", note_id, None). Each runs in its own savepoint, so one that
+        fails is rolled back without affecting the others.
+        Returns Success(list_of_results), one per operation in order, or Failure
+        if the batch could not be committed, in which case nothing was applied.
+        """
+        results: list[Result] = []
+        try:
+            # Edits read notes before writing revisions against them, so hold the
+            # write lock throughout. The open transaction also keeps releasing an
+            # operation's savepoint from committing.
+            DAL._begin_write(db_)
+            for op, note_id, content in operations:
+                db_.execute("SAVEPOINT op")
+                res = DAL._apply_note_operation(db_, user_id, op, note_id, content, cache)
+                if isinstance(res, Success):
+                    try:
+                        # Reading the result waits for it, so on a pipelined connection
+                        # an error from this operation surfaces here, not in the next one
+                        db_.execute("RELEASE op").fetchall()
+                        results.append(res)
+                        continue
+                    except sqlite3.Error as e:
+                        audit_log.record(
+                            "db.error", operation="apply_note_batch", error=str(e)
+                        )
+                        res = Failure("Could not apply the operation due to a database error.")
+                db_.execute("ROLLBACK TO op")
+                db_.execute("RELEASE op").fetchall()
+                if cache is not None:
+                    # It may hold permissions the rollback just undid
+                    cache.clear()
+                results.append(res)
+            db_.commit()
+            return Success(results)
+        except sqlite3.Error as e:
+            db_.rollback()
+            audit_log.record("db.error", operation="apply_note_batch", error=str(e))
+            return Failure("Could not apply the batch due to a database error.")
+
+    @staticmethod
+    def _begin_write(db_: DbConnection) -> None:
+        """
+        Starts a transaction holding the database's write lock, unless one is already open.
+        No other connection can write until it is committed or rolled back.
+        """
+        if not db_.in_transaction:
+            db_.execute("BEGIN IMMEDIATE")
+
+    @staticmethod
+    def _apply_note_operation(
+        db_: DbConnection,
+        user_id: int,
+        op: str,
+        note_id: int | None,
+        content: str | None,
+        cache: PermissionCache | None,
+    ) -> Result:
+        """
+        Runs one batch operation without committing.
+        """
+        if op == "create":
+            return DAL.create_note_for_user(db_, user_id, content, commit=False, cache=cache)
+        if op == "edit":
+            return DAL.edit_note(db_, note_id, user_id, content, commit=False, cache=cache)
+        if op == "delete":
+            return DAL.delete_note(db_, note_id, user_id, commit=False, cache=cache)
+        return Failure(f"Unknown operation: {op}")
+
+    @staticmethod
+    def _append_revision(
+        db_: DbConnection, note_id: int, previous: str | None, content: str
+    ) -> None:
+        """
+        Adds content as the newest revision of a note without committing.
+        previous is the note's content before this change, or None for a new note.
+        Notes created before history existed get their previous content saved first.
+        """
+        latest = db_.execute(
+            "SELECT MAX(revision) FROM note_revisions WHERE note_id = ?", (note_id,)
+        ).fetchone()[0]
+
+        if latest is None and previous is None:
+            revision, kind, payload = 0, "snapshot", content
+        else:
+            if latest is None:
+                db_.execute(
+                    """
+                    INSERT INTO note_revisions (note_id, revision, kind, payload)
+                    VALUES (?, 0, 'snapshot', ?)
+                    """,
+                    (note_id, previous),
+                )
+                latest = 0
+            revision = latest + 1
+            if revision % SNAPSHOT_INTERVAL == 0:
+                kind, payload = "snapshot", content
+            else:
+                kind, payload = "delta", make_delta(previous, content)
+
+        db_.execute(
+            """
+            INSERT INTO note_revisions (note_id, revision, kind, payload)
+            VALUES (?, ?, ?, ?)
+            """,
+            (note_id, revision, kind, payload),
+        )
+
+    @staticmethod
+    def _rebuild_revision(db_: DbConnection, note_id: int, revision: int) -> str | None:
+        """
+        Rebuilds the content of a note at the given revision from the nearest
+        snapshot at or before it. Returns None if the revision does not exist.
+        """
+        rows = db_.execute(
+            """
+            SELECT revision, kind, payload FROM note_revisions
+            WHERE note_id = ?
+            AND revision <= ?
+            AND revision >= (
+                SELECT MAX(revision) FROM note_revisions
+                WHERE note_id = ? AND revision <= ? AND kind = 'snapshot'
+            )
+            ORDER BY revision
+            """,
+            (note_id, revision, note_id, revision),
+        ).fetchall()
+
+        if not rows or rows[-1][0] != revision:
+            return None
+        return rebuild([(kind, payload) for _, kind, payload in rows])
+
+    @staticmethod
+    def get_note_history(
+        db_: DbConnection,
+        note_id: int,
+        user_id: int,
+        page: int = 0,
+        cache: PermissionCache | None = None,
+    ) -> Result[Tuple[list[Tuple], bool], str]:
+        """
+        Retrieves one page of a note's revisions, newest first.
+        Returns Success((list_of_revisions, has_more_pages)) or Failure.
+        """
+        try:
+            note = DAL._fetch_note(db_, note_id, user_id, PERMISSION_READ, cache)
+
+            if not note:
+                return Failure("You do not have a note with the given id.")
+
+            # Ask for one extra row to find out whether there is another page
+            revisions = db_.execute(
+                """
+                SELECT revision, created_at FROM note_revisions
+                WHERE note_id = ?
+                ORDER BY revision DESC
+                LIMIT ? OFFSET ?
+                """,
+                (note_id, HISTORY_PAGE_SIZE + 1, max(page, 0) * HISTORY_PAGE_SIZE),
+            ).fetchall()
+            return Success(
+                (revisions[:HISTORY_PAGE_SIZE], len(revisions) > HISTORY_PAGE_SIZE)
+            )
+        except sqlite3.Error as e:
+            audit_log.record("db.error", operation="get_note_history", error=str(e))
+            return Failure("Could not retrieve note history due to a database error.")
+
+    @staticmethod
+    def get_note_revision(
+        db_: DbConnection,
+        note_id: int,
+        user_id: int,
+        revision: int,
+        cache: PermissionCache | None = None,
+    ) -> Result[str, str]:
+        """
+        Retrieves the content of a note as it was at the given revision.
+        Returns Success(content) or Failure.
+        """
+        try:
+            note = DAL._fetch_note(db_, note_id, user_id, PERMISSION_READ, cache)
+
+            if not note:
+                return Failure("You do not have a note with the given id.")
+
+            content = DAL._rebuild_revision(db_, note_id, revision)
+            if content is None:
+                return Failure("That revision of the note does not exist.")
+            return Success(content)
+        except sqlite3.Error as e:
+            audit_log.record("db.error", operation="get_note_revision", error=str(e))
+            return Failure("Could not retrieve note revision due to a database error.")
+
+    @staticmethod
+    def restore_note_revision(
+        db_: DbConnection,
+        note_id: int,
+        user_id: int,
+        revision: int,
+        cache: PermissionCache | None = None,
+    ) -> Result[None, str]:
+        """
+        Restores a note to the content it had at the given revision.
+        The restore is saved as a new revision, so it can be undone too.
+        Returns Success() or Failure.
+        """
+        res_revision = DAL.get_note_revision(db_, note_id, user_id, revision, cache)
+        if isinstance(res_revision, Failure):
+            return res_revision
+        return DAL.edit_note(db_, note_id, user_id, res_revision.unwrap(), cache=cache)
+
+    @staticmethod
+    def compact_history(db_: DbConnection, keep: int) -> Result[int, str]:
+        """
+        Retention job: drops all but the newest keep revisions of every note.
+        The oldest kept revision is rewritten as a snapshot so it can still be rebuilt.
+        Returns Success(number_of_revisions_removed) or Failure.
+        """
+        if keep < 1:
+            return Failure("At least one revision must be kept.")
+        try:
+            notes = db_.execute(
+                """
+                SELECT note_id, MAX(revision) FROM note_revisions
+                GROUP BY note_id
+                HAVING COUNT(*) > ?
+                """,
+                (keep,),
+            ).fetchall()
+
+            removed = 0
+            for note_id, latest in notes:
+                cutoff = latest - keep + 1
+                content = DAL._rebuild_revision(db_, note_id, cutoff)
+                if content is None:
+                    continue
+                db_.execute(
+                    """
+                    UPDATE note_revisions
+                    SET kind = 'snapshot', payload = ?
+                    WHERE note_id = ? AND revision = ?
+                    """,
+                    (content, note_id, cutoff),
+                )
+                cursor = db_.execute(
+                    "DELETE FROM note_revisions WHERE note_id = ? AND revision < ?",
+                    (note_id, cutoff),
+                )
+                db_.commit()
+                removed += cursor.rowcount
+            return Success(removed)
+        except sqlite3.Error as e:
+            audit_log.record("db.error", operation="compact_history", error=str(e))
+            return Failure("Could not compact note history due to a database error.")
@@ -0,0 +1,265 @@
+"""
+An in-process scheduler for database maintenance.
+
+Every app process starts a scheduler, but only the one holding an exclusive lock
+on the lock file runs jobs, so maintenance never runs twice at once. If the
+leader exits, its lock is released and another process takes over.
+
+Jobs yield to foreground traffic: before each step the scheduler waits until no
+request is in flight and none has started for quiet_period seconds, up to
+max_defer seconds. Long jobs are split into small steps with pauses in between.
+
+Every process also touches the activity file when a request starts or finishes,
+so the leader yields to the other workers' traffic too. It only sees their
+requests start and finish, not run, so one still running after quiet_period is
+not waited for.
+"""
+
+import fcntl
+import heapq
+import os
+import sqlite3
+import threading
+import time
+
+from returns.result import Failure, Result
+
+from audit import audit_log
+from backup import create_backup
+from dal import DAL
+from revisions import DEFAULT_RETAINED_REVISIONS
+
+
+class Scheduler:
+    """
+    Runs ANALYZE, incremental vacuum, WAL checkpoints, note history expiry and
+    backups on their own intervals, configured by the "maintenance" and "backup"
+    sections of config.json.
+    """
+
+    def __init__(self):
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._last_request = 0.0
+        self._lock_file = None
+        self._activity_path: str | None = None
+        self.db_path = "database.db"
+        self.config: dict = {}
+        self.backup_config: dict = {}
+
+    def start(
+        self, db_path: str, config: dict | None = None, backup_config: dict | None = None
+    ) -> None:
+        """
+        Starts the scheduler thread. Every key of both configs is optional.
+        """
+        if self._thread is not None:
+            return
+        self.db_path = db_path
+        self.config = config or {}
+        self.backup_config = backup_config or {}
+        self._activity_path = self._setting("activity_path", "maintenance.activity")
+        try:
+            with open(self._activity_path, "ab"):
+                pass
+        except OSError:
+            self._activity_path = None
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="maintenance", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """
+        Stops the scheduler thread, giving up leadership.
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def request_started(self) -> None:
+        """
+        Called at the start of every request so jobs can stay out of its way.
+        """
+        with self._lock:
+            self._in_flight += 1
+            self._last_request = time.monotonic()
+        self._mark_activity()
+
+    def request_finished(self) -> None:
+        """
+        Called at the end of every request.
+        """
+        with self._lock:
+            self._in_flight -= 1
+        self._mark_activity()
+
+    def _mark_activity(self) -> None:
+        """
+        Sets the activity file's modification time to now, so the leader can see
+        this process's traffic. Does nothing before start().
+        """
+        if self._activity_path is None:
+            return
+        try:
+            os.utime(self._activity_path)
+        except OSError:
+            # A lost mark only makes maintenance less polite, it mustn't fail the request
+            pass
+
+    def _shared_idle_for(self) -> float:
+        """
+        Returns how many seconds ago any process last marked activity.
+        """
+        try:
+            return time.time() - os.stat(self._activity_path).st_mtime
+        except (OSError, TypeError):
+            return float("inf")
+
+    def _setting(self, key: str, default):
+        """Reads a setting from the config, falling back to default."""
+        return self.config.get(key, default)
+
+    def _is_leader(self) -> bool:
+        """
+        Tries to take the lock file without waiting. Returns whether this process holds it.
+        """
+        if self._lock_file is not None:
+            return True
+        # pylint: disable=consider-using-with
+        lock_file = open(self._setting("lock_path", "maintenance.lock"), "a+b")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        audit_log.record("maintenance.leader")
+        return True
+
+    def _wait_for_quiet(self) -> None:
+        """
+        Blocks until there has been no foreground traffic for quiet_period seconds,
+        or max_defer seconds have passed, whichever comes first.
+        """
+        quiet_period = self._setting("quiet_period", 0.5)
+        deadline = time.monotonic() + self._setting("max_defer", 60.0)
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            with self._lock:
+                busy = self._in_flight > 0
+                idle_for = time.monotonic() - self._last_request
+            idle_for = min(idle_for, self._shared_idle_for())
+            if not busy and idle_for >= quiet_period:
+                return
+            self._stop.wait(min(quiet_period, 0.05))
+
+    def _run(self) -> None:
+        """
+        The scheduler thread: waits for leadership, then runs each job when it is due.
+        """
+        jobs = [
+            ("analyze", self._analyze, self._setting("analyze_interval", 3600)),
+            ("vacuum", self._incremental_vacuum, self._setting("vacuum_interval", 600)),
+            ("checkpoint", self._checkpoint, self._setting("checkpoint_interval", 300)),
+            ("expire", self._expire_history, self._setting("expire_interval", 86400)),
+        ]
+        # Scheduled backups are off unless the backup config sets an interval
+        if self.backup_config.get("interval"):
+            jobs.append(("backup", self._backup, self.backup_config["interval"]))
+
+        while not self._is_leader():
+            if self._stop.wait(self._setting("leader_retry", 30)):
+                return
+
+        db_ = None
+        try:
+            db_ = sqlite3.connect(
+                self.db_path, timeout=self._setting("busy_timeout", 1.0)
+            )
+            now = time.monotonic()
+            queue = [(now + interval, name, job, interval) for name, job, interval in jobs]
+            heapq.heapify(queue)
+
+            while queue:
+                due, name, job, interval = heapq.heappop(queue)
+                if self._stop.wait(max(0.0, due - time.monotonic())):
+                    break
+                self._wait_for_quiet()
+                self._run_job(name, job, db_)
+                heapq.heappush(queue, (time.monotonic() + interval, name, job, interval))
+        finally:
+            # Always hand over leadership, or no process would run maintenance again
+            if db_ is not None:
+                db_.close()
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _run_job(self, name: str, job, db_: sqlite3.Connection) -> None:
+        """
+        Runs one job and records how it went. A job that fails is retried at its
+        next interval, whatever it raised.
+        """
+        started = time.monotonic()
+        try:
+            res = job(db_)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            res = Failure(f"{type(e).__name__}: {e}")
+        if isinstance(res, Failure):
+            # Don't let a half done job's transaction keep holding the write lock
+            db_.rollback()
+            audit_log.record("maintenance.error", job=name, error=res.failure())
+        else:
+            audit_log.record("maintenance.run", job=name, seconds=time.monotonic() - started)
+
+    def _analyze(self, db_: sqlite3.Connection) -> None:
+        """
+        Refreshes the query planner's statistics, sampling at most analysis_limit rows per index.
+        """
+        db_.execute(f"PRAGMA analysis_limit = {int(self._setting('analysis_limit', 1000))}")
+        db_.execute("ANALYZE")
+
+    def _incremental_vacuum(self, db_: sqlite3.Connection) -> None:
+        """
+        Returns free pages to the filesystem a small batch at a time.
+        """
+        pages = int(self._setting("vacuum_pages", 100))
+        pause = self._setting("step_pause", 0.05)
+        while not self._stop.is_set():
+            free = db_.execute("PRAGMA freelist_count").fetchone()[0]
+            if free == 0:
+                return
+            # execute() only steps this pragma once, freeing a single page.
+            # executescript() runs it to completion.
+            db_.executescript(f"PRAGMA incremental_vacuum({min(free, pages)});")
+            self._stop.wait(pause)
+            self._wait_for_quiet()
+
+    def _checkpoint(self, db_: sqlite3.Connection) -> None:
+        """
+        Copies the WAL back into the database and truncates it.
+        """
+        busy, _, _ = db_.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        if busy:
+            audit_log.record("maintenance.checkpoint_busy")
+
+    def _expire_history(self, db_: sqlite3.Connection) -> Result[int, str]:
+        """
+        Drops note revisions past the retention limit.
+        """
+        return DAL.compact_history(
+            db_, self._setting("retained_revisions", DEFAULT_RETAINED_REVISIONS)
+        )
+
+    def _backup(self, db_: sqlite3.Connection) -> Result[str, str]:
+        """
+        Takes an online backup and prunes old ones.
+        """
+        return create_backup(db_, self.backup_config)
+
+
+scheduler = Scheduler()
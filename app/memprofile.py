@@ -0,0 +1,73 @@
+"""
+Live memory profiling for a running app process, driven by signals.
+
+When enabled, send the process SIGUSR1 to start tracemalloc and take a baseline
+snapshot. Each later SIGUSR1 writes the top allocators, and the biggest growth
+since the baseline, to memory-<pid>.txt in dump_dir. SIGUSR2 stops tracing.
+
+benchmarks/profile_memory.py --live <pid> does this for you.
+"""
+
+import os
+import signal
+import threading
+import tracemalloc
+from datetime import datetime, timezone
+
+_baseline: tracemalloc.Snapshot | None = None
+_config: dict = {}
+
+
+def dump_path(pid: int, dump_dir: str = ".") -> str:
+    """Where the process with the given pid writes its dumps."""
+    return os.path.join(dump_dir, f"memory-{pid}.txt")
+
+
+def _dump() -> None:
+    """Writes the top allocators and the growth since the baseline snapshot."""
+    top = _config.get("top", 25)
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+    lines = [f"=== {datetime.now(timezone.utc).isoformat()} ==="]
+    current, peak = tracemalloc.get_traced_memory()
+    lines.append(f"traced: {current} bytes, peak: {peak} bytes")
+    lines.append(f"--- top {top} allocators ---")
+    lines += [str(stat) for stat in snapshot.statistics("lineno")[:top]]
+    lines.append(f"--- top {top} growth since tracing started ---")
+    lines += [str(stat) for stat in snapshot.compare_to(_baseline, "lineno")[:top]]
+
+    path = dump_path(os.getpid(), _config.get("dump_dir", "."))
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n\n")
+
+
+def _on_usr1(_signum, _frame) -> None:
+    """Starts tracing, or dumps if tracing already started."""
+    global _baseline  # pylint: disable=global-statement
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(_config.get("frames", 1))
+        _baseline = tracemalloc.take_snapshot()
+        return
+    # Snapshots can take a while, don't hold up the request the signal interrupted
+    threading.Thread(target=_dump, name="memory-dump", daemon=True).start()
+
+
+def _on_usr2(_signum, _frame) -> None:
+    """Stops tracing."""
+    global _baseline  # pylint: disable=global-statement
+    tracemalloc.stop()
+    _baseline = None
+
+
+def install(config: dict | None = None) -> None:
+    """
+    Installs the signal handlers if the "memory_profiling" config section enables them.
+    Must be called from the main thread.
+    """
+    global _config  # pylint: disable=global-statement
+    _config = config or {}
+    if not _config.get("enabled", False):
+        return
+    signal.signal(signal.SIGUSR1, _on_usr1)
+    signal.signal(signal.SIGUSR2, _on_usr2)
@@ -0,0 +1,100 @@
+"""
+Delta encoding for note revision history.
+
+Each edit to a note is stored as a compact delta against the previous version,
+with a full snapshot every SNAPSHOT_INTERVAL revisions. Rebuilding any revision
+therefore never applies more than SNAPSHOT_INTERVAL - 1 deltas.
+
+A delta is a JSON list of operations applied left to right over the old text:
+    positive int n -> copy the next n characters from the old text
+    negative int n -> skip the next -n characters of the old text
+    str s          -> insert s
+"""
+
+import json
+import sys
+import sqlite3
+from difflib import SequenceMatcher
+
+# Write a full copy of the note every this many revisions to bound rebuild cost
+SNAPSHOT_INTERVAL = 50
+# How many revisions to show per page of the history listing
+HISTORY_PAGE_SIZE = 20
+# How many of the newest revisions the compaction job keeps per note
+DEFAULT_RETAINED_REVISIONS = 200
+
+
+def make_delta(old: str, new: str) -> str:
+    """
+    Encodes the changes that turn old into new as a serialized delta.
+    """
+    # Most edits touch a small span, so only diff what lies between the
+    # common prefix and suffix. SequenceMatcher is slow on long inputs.
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+
+    ops: list = [prefix] if prefix else []
+    old_mid = old[prefix : len(old) - suffix]
+    new_mid = new[prefix : len(new) - suffix]
+    matcher = SequenceMatcher(None, old_mid, new_mid, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append(i2 - i1)
+            continue
+        if i2 > i1:
+            ops.append(i1 - i2)
+        if j2 > j1:
+            ops.append(new_mid[j1:j2])
+    if suffix:
+        ops.append(suffix)
+    return json.dumps(ops, separators=(",", ":"))
+
+
+def apply_delta(old: str, delta: str) -> str:
+    """
+    Applies a serialized delta made by make_delta to old, returning the new text.
+    """
+    parts = []
+    pos = 0
+    for op in json.loads(delta):
+        if isinstance(op, str):
+            parts.append(op)
+        elif op >= 0:
+            parts.append(old[pos : pos + op])
+            pos += op
+        else:
+            pos -= op
+    return "".join(parts)
+
+
+def rebuild(rows: list) -> str:
+    """
+    Rebuilds the content of a revision from (kind, payload) rows, ordered oldest first,
+    where the first row is a snapshot and the rest are deltas.
+    """
+    content = ""
+    for kind, payload in rows:
+        content = payload if kind == "snapshot" else apply_delta(content, payload)
+    return content
+
+
+if __name__ == "__main__":
+    # Retention job: python app/revisions.py [revisions_to_keep]
+    # Imported here to avoid a circular import, dal imports this module.
+    from returns.result import Failure
+    from dal import DAL
+
+    with open("config.json", "r", encoding="utf-8") as f:
+        db_path = json.load(f).get("storage", {}).get("path", "database.db")
+    keep = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RETAINED_REVISIONS
+    db = sqlite3.connect(db_path)
+    res = DAL.compact_history(db, keep)
+    db.close()
+    if isinstance(res, Failure):
+        sys.exit(res.failure())
+    print(f"Removed {res.unwrap()} old note revisions.")
@@ -5,11 +5,18 @@ This module just exists to store the seed functions for the database for develop
 import json
 from returns.result import Failure
 from validators import validate_registration
-from dal import DAL
+from dal import DAL, PERMISSION_OWNER
 
 
 def init_db(db_):
     """Initializes the db tables"""
+    # Let the maintenance scheduler return freed pages with incremental_vacuum.
+    # Databases made before this setting need one full VACUUM for it to apply.
+    if db_.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        db_.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db_.execute("VACUUM")
+    # WAL lets maintenance and readers run alongside a writer
+    db_.execute("PRAGMA journal_mode = WAL")
     db_.execute(
         """
         CREATE TABLE IF NOT EXISTS users (
@@ -28,6 +35,49 @@ def init_db(db_):
         )
         """
     )
+    # Who can do what with each note, see the PERMISSION_ levels in dal.py.
+    # Keyed on (user_id, note_id) so checks and "shared with me" lookups use the key.
+    has_permissions = db_.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_permissions'"
+    ).fetchone()
+    db_.execute(
+        """
+        CREATE TABLE IF NOT EXISTS note_permissions (
+            note_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            level INTEGER NOT NULL,
+            PRIMARY KEY (user_id, note_id)
+        ) WITHOUT ROWID
+        """
+    )
+    db_.execute(
+        "CREATE INDEX IF NOT EXISTS note_permissions_note ON note_permissions (note_id)"
+    )
+    db_.execute("CREATE INDEX IF NOT EXISTS notes_user ON notes (user_id)")
+    if not has_permissions:
+        # Notes made before sharing existed only have an owner
+        db_.execute(
+            """
+            INSERT INTO note_permissions (note_id, user_id, level)
+            SELECT id, user_id, ? FROM notes
+            """,
+            (PERMISSION_OWNER,),
+        )
+        db_.commit()
+    # Append-only edit history, see revisions.py for the payload format
+    db_.execute(
+        """
+        CREATE TABLE IF NOT EXISTS note_revisions (
+            id INTEGER PRIMARY KEY,
+            note_id INTEGER NOT NULL,
+            revision INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (note_id, revision)
+        )
+        """
+    )
 
 
 def seed_db(db_):
@@ -0,0 +1,419 @@
+"""
+Pluggable storage backends for the DAL.
+
+The DAL only needs a small part of a sqlite3.Connection: execute() returning a
+cursor with fetchone(), fetchall(), rowcount and lastrowid, plus commit(),
+rollback() and in_transaction. DbConnection describes that, and there are two
+backends providing it:
+
+    SqliteBackend - a local database file, one sqlite3 connection per request
+    RemoteBackend - a pool of connections to the storage daemon in storage_server.py,
+                    so several stateless app nodes can share one database
+
+The remote protocol is a stream of length-prefixed binary frames. Each request is
+an opcode byte and an encoded list of arguments. Each response is a status byte
+and an encoded list. Requests are pipelined: execute() only queues its request
+and returns straight away, and responses are read in order the first time a
+result is needed. A write followed by commit() therefore costs one round trip.
+
+The server reports errors with the sqlite3 exception name, and the client raises
+the same exception type, so the DAL's error handling works on either backend.
+Successful responses also say whether the server's connection is left inside a
+transaction, so a pooled connection can be rolled back before it is reused.
+"""
+
+import os
+import socket
+import sqlite3
+import struct
+import threading
+from typing import Any, Protocol, Sequence
+
+# Request opcodes
+OP_AUTH = b"A"
+OP_EXECUTE = b"E"
+OP_COMMIT = b"C"
+OP_ROLLBACK = b"B"
+OP_RESUME = b"U"
+# Response statuses
+STATUS_OK = b"R"
+STATUS_ERROR = b"X"
+STATUS_SKIPPED = b"K"
+
+_FRAME = struct.Struct(">I")
+_INT = struct.Struct(">q")
+_FLOAT = struct.Struct(">d")
+# Refuse frames bigger than this instead of trying to buffer them
+MAX_FRAME = 64 * 1024 * 1024
+
+
+class DbCursor(Protocol):
+    """The parts of sqlite3.Cursor the DAL uses."""
+
+    rowcount: int
+    lastrowid: int | None
+
+    def fetchone(self) -> Any:
+        """Returns the next row, or None."""
+
+    def fetchall(self) -> list:
+        """Returns the remaining rows."""
+
+
+class DbConnection(Protocol):
+    """The parts of sqlite3.Connection the DAL uses."""
+
+    in_transaction: bool
+
+    def execute(self, sql: str, parameters: Sequence = ...) -> DbCursor:
+        """Runs one statement."""
+
+    def commit(self) -> None:
+        """Commits the current transaction."""
+
+    def rollback(self) -> None:
+        """Rolls back the current transaction."""
+
+
+def encode(value, out: bytearray) -> None:
+    """
+    Appends value to out. Handles the types SQLite stores, plus lists and tuples of them.
+    """
+    if value is None:
+        out += b"N"
+    elif isinstance(value, int):
+        out += b"I"
+        out += _INT.pack(value)
+    elif isinstance(value, float):
+        out += b"F"
+        out += _FLOAT.pack(value)
+    elif isinstance(value, str):
+        data = value.encode()
+        out += b"S"
+        out += _FRAME.pack(len(data))
+        out += data
+    elif isinstance(value, bytes):
+        out += b"Y"
+        out += _FRAME.pack(len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out += b"L"
+        out += _FRAME.pack(len(value))
+        for item in value:
+            encode(item, out)
+    else:
+        raise TypeError(f"Cannot send {type(value).__name__} to the storage server.")
+
+
+def decode(data: memoryview, pos: int = 0) -> tuple[Any, int]:
+    """
+    Reads one value from data at pos, tuples come back as lists.
+    Returns (value, position after it).
+    """
+    tag = data[pos : pos + 1].tobytes()
+    pos += 1
+    if tag == b"N":
+        return None, pos
+    if tag == b"I":
+        return _INT.unpack_from(data, pos)[0], pos + 8
+    if tag == b"F":
+        return _FLOAT.unpack_from(data, pos)[0], pos + 8
+    if tag in (b"S", b"Y"):
+        size = _FRAME.unpack_from(data, pos)[0]
+        pos += 4
+        raw = data[pos : pos + size].tobytes()
+        return (raw.decode() if tag == b"S" else raw), pos + size
+    if tag == b"L":
+        count = _FRAME.unpack_from(data, pos)[0]
+        pos += 4
+        items = []
+        for _ in range(count):
+            item, pos = decode(data, pos)
+            items.append(item)
+        return items, pos
+    raise ValueError(f"Unknown value tag {tag!r} from the storage server.")
+
+
+def pack_frame(opcode: bytes, args: list) -> bytes:
+    """Builds one frame: length, opcode or status byte, then the encoded args."""
+    body = bytearray(opcode)
+    encode(args, body)
+    return _FRAME.pack(len(body)) + body
+
+
+def read_frame(stream) -> tuple[bytes, list] | None:
+    """
+    Reads one frame from a binary file-like stream.
+    Returns (opcode_or_status, args), or None if the stream has closed.
+    """
+    header = stream.read(4)
+    if len(header) < 4:
+        return None
+    size = _FRAME.unpack(header)[0]
+    if size < 1 or size > MAX_FRAME:
+        raise ValueError("Bad frame size from the storage server.")
+    body = stream.read(size)
+    if len(body) < size:
+        return None
+    args, _ = decode(memoryview(body), 1)
+    return body[:1], args
+
+
+def error_from(kind: str, message: str) -> sqlite3.Error:
+    """Rebuilds the sqlite3 exception the server reported."""
+    error_type = getattr(sqlite3, kind, None)
+    if not (isinstance(error_type, type) and issubclass(error_type, sqlite3.Error)):
+        error_type = sqlite3.DatabaseError
+    return error_type(message)
+
+
+def parse_address(address: str) -> tuple[int, Any]:
+    """
+    Parses "unix:/path/to/socket" or "tcp:host:port" into (socket family, address).
+    """
+    kind, _, rest = address.partition(":")
+    if kind == "unix":
+        return socket.AF_UNIX, rest
+    if kind == "tcp":
+        host, _, port = rest.rpartition(":")
+        return socket.AF_INET, (host, int(port))
+    raise ValueError(f"Storage address must start with unix: or tcp:, got {address}")
+
+
+class RemoteCursor:
+    """
+    The result of one pipelined execute(). Reading any attribute waits for it.
+    """
+
+    def __init__(self, connection: "RemoteConnection", epoch: int):
+        self._connection = connection
+        self.epoch = epoch
+        self.done = False
+        self._rows: list = []
+        self._rowcount = -1
+        self._lastrowid: int | None = None
+
+    def set_result(self, rows: list, rowcount: int, lastrowid: int | None) -> None:
+        """Called by the connection when this cursor's response arrives."""
+        self._rows = [tuple(row) for row in rows]
+        self._rowcount, self._lastrowid = rowcount, lastrowid
+        self.done = True
+
+    def _wait(self) -> None:
+        """Reads responses until this cursor's has arrived."""
+        if not self.done:
+            self._connection.wait_for(self)
+
+    @property
+    def rowcount(self) -> int:
+        """Rows changed by the statement, as in sqlite3."""
+        self._wait()
+        return self._rowcount
+
+    @property
+    def lastrowid(self) -> int | None:
+        """Row id of the last inserted row, as in sqlite3."""
+        self._wait()
+        return self._lastrowid
+
+    def fetchone(self):
+        """Returns the next row, or None."""
+        self._wait()
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self) -> list:
+        """Returns the remaining rows."""
+        self._wait()
+        rows, self._rows = self._rows, []
+        return rows
+
+
+class RemoteConnection:
+    """
+    A DbConnection to the storage daemon. Like sqlite3.Connection, one instance
+    must only be used by one thread at a time.
+    """
+
+    def __init__(self, address: str, token: str = "", timeout: float = 10.0):
+        family, target = parse_address(address)
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(target)
+        if family == socket.AF_INET:
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._sock.makefile("rb")
+        # Requests written but not yet sent, and cursors still waiting for a response
+        self._outgoing = bytearray()
+        self._pending: list[RemoteCursor] = []
+        # Bumped by reset(), errors from before the last reset are not raised
+        self._epoch = 0
+        self.broken = False
+        # Whether the server's connection was inside a transaction after the last response
+        self.in_transaction = False
+        self._send(OP_AUTH, [token])
+
+    def _send(self, opcode: bytes, args: list) -> RemoteCursor:
+        """Queues a request, returning the cursor its response will fill in."""
+        self._outgoing += pack_frame(opcode, args)
+        cursor = RemoteCursor(self, self._epoch)
+        self._pending.append(cursor)
+        return cursor
+
+    def _read_response(self) -> sqlite3.Error | None:
+        """
+        Reads the next response into the oldest pending cursor.
+        Returns the error it reported, if it failed since the last reset.
+        """
+        frame = read_frame(self._reader)
+        if frame is None:
+            raise OSError("the storage server closed the connection")
+        status, args = frame
+        cursor = self._pending.pop(0)
+        if status == STATUS_OK:
+            rows, rowcount, lastrowid, self.in_transaction = args
+            cursor.set_result(rows, rowcount, lastrowid)
+            return None
+        # A failed or skipped request may have left a transaction open
+        self.in_transaction = True
+        cursor.set_result([], -1, None)
+        if status == STATUS_ERROR and cursor.epoch == self._epoch:
+            return error_from(*args)
+        return None
+
+    def wait_for(self, cursor: RemoteCursor) -> None:
+        """
+        Sends any queued requests, then reads responses up to and including cursor's.
+        If an earlier request failed, raises its error. The server skips everything
+        sent after a failed request, just as a local connection would never have run it.
+        """
+        try:
+            if self._outgoing:
+                self._sock.sendall(self._outgoing)
+                self._outgoing.clear()
+
+            error = None
+            while not cursor.done:
+                failure = self._read_response()
+                error = error or failure
+            if error is not None:
+                # Everything still pending was skipped, collect it and let the server carry on
+                while self._pending:
+                    self._read_response()
+                self._send(OP_RESUME, [])
+        except (OSError, ValueError) as e:
+            self.broken = True
+            raise sqlite3.OperationalError(
+                f"Lost connection to the storage server: {e}"
+            ) from e
+        if error is not None:
+            raise error
+
+    def execute(self, sql: str, parameters: Sequence = ()) -> RemoteCursor:
+        """Queues a statement. Its result is only waited for when it is read."""
+        return self._send(OP_EXECUTE, [sql, list(parameters)])
+
+    def commit(self) -> None:
+        """Commits, raising the error of any queued statement that failed."""
+        self.wait_for(self._send(OP_COMMIT, []))
+
+    def rollback(self) -> None:
+        """Rolls back, raising the error of any queued statement that failed."""
+        self.wait_for(self._send(OP_ROLLBACK, []))
+
+    def reset(self) -> None:
+        """
+        Readies the connection for its next user, forgetting errors from unread results.
+        If a transaction may be open, rolls it back and waits for that, so an idle
+        pooled connection never holds a lock. Otherwise this costs no round trip.
+        """
+        self._epoch += 1
+        if not (self._outgoing or self._pending or self.in_transaction):
+            return
+        self._send(OP_RESUME, [])
+        self.rollback()
+
+    def close(self) -> None:
+        """Closes the socket."""
+        self._reader.close()
+        self._sock.close()
+
+
+class SqliteBackend:
+    """Opens a sqlite3 connection to a local database file for each request."""
+
+    def __init__(self, path: str = "database.db"):
+        self.path = path
+
+    def connect(self) -> DbConnection:
+        """Opens a connection."""
+        return sqlite3.connect(self.path)
+
+    def release(self, db_) -> None:
+        """Closes a connection, discarding anything uncommitted."""
+        db_.close()
+
+    def close(self) -> None:
+        """Nothing to clean up."""
+
+
+class RemoteBackend:
+    """
+    Hands out pooled connections to the storage daemon. Connections are reused
+    across requests, and at most pool_size idle ones are kept open.
+    """
+
+    def __init__(self, address: str, token: str = "", pool_size: int = 8):
+        self.address = address
+        self.token = token
+        self.pool_size = pool_size
+        self._idle: list[RemoteConnection] = []
+        self._lock = threading.Lock()
+
+    def connect(self) -> DbConnection:
+        """Takes an idle connection from the pool, or opens a new one."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return RemoteConnection(self.address, self.token)
+        except OSError as e:
+            raise sqlite3.OperationalError(
+                f"Could not reach the storage server: {e}"
+            ) from e
+
+    def release(self, db_) -> None:
+        """Returns a connection to the pool, discarding anything uncommitted."""
+        try:
+            db_.reset()
+        except sqlite3.Error:
+            # Most likely broken, and never worth handing to someone else
+            db_.broken = True
+        if db_.broken:
+            db_.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(db_)
+                return
+        db_.close()
+
+    def close(self) -> None:
+        """Closes every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for db_ in idle:
+            db_.close()
+
+
+def open_backend(config: dict | None = None):
+    """
+    Builds the backend described by the "storage" section of config.json.
+    The STORAGE_ADDRESS and STORAGE_TOKEN environment variables override it,
+    so containers can be pointed at a shared store without editing the file.
+    """
+    config = config or {}
+    address = os.environ.get("STORAGE_ADDRESS") or config.get("address")
+    token = os.environ.get("STORAGE_TOKEN") or config.get("token", "")
+    if config.get("backend") == "remote" or os.environ.get("STORAGE_ADDRESS"):
+        return RemoteBackend(address, token, config.get("pool_size", 8))
+    return SqliteBackend(config.get("path", "database.db"))
@@ -0,0 +1,217 @@
+"""
+The storage daemon behind RemoteBackend, see storage.py for the protocol.
+
+It owns the database file (storage.path in config.json) and runs its schema
+setup, seeding and maintenance, so any number of stateless app nodes can share it. Each client socket gets its own
+sqlite3 connection, and therefore its own transaction. Requests arriving together
+are answered together in one send, which is what makes pipelining pay off.
+
+Usage, from the project root:
+    python app/storage_server.py
+"""
+
+import hmac
+import json
+import os
+import signal
+import socket
+import socketserver
+import sqlite3
+import struct
+import sys
+
+from audit import audit_log
+from maintenance import scheduler
+from seed_db import init_db, seed_db
+from storage import (
+    MAX_FRAME,
+    OP_AUTH,
+    OP_COMMIT,
+    OP_EXECUTE,
+    OP_RESUME,
+    OP_ROLLBACK,
+    STATUS_ERROR,
+    STATUS_OK,
+    STATUS_SKIPPED,
+    decode,
+    pack_frame,
+    parse_address,
+)
+
+_FRAME = struct.Struct(">I")
+
+
+class StorageSession(socketserver.BaseRequestHandler):
+    """Serves one client connection until it closes."""
+
+    def setup(self):
+        self.db_ = sqlite3.connect(self.server.db_path, timeout=self.server.busy_timeout)
+        self.authenticated = False
+        # After a request fails, later pipelined requests are skipped until the client
+        # sends OP_RESUME, because a local connection would have raised before running them
+        self.failed = False
+
+    def finish(self):
+        self.db_.close()
+
+    def handle(self):
+        try:
+            self._serve()
+        except (OSError, ValueError, struct.error):
+            # The client went away or sent garbage, either way drop it
+            return
+
+    def _serve(self):
+        """Reads requests until the client disconnects, answering each batch in one send."""
+        buffer = bytearray()
+        while True:
+            data = self.request.recv(256 * 1024)
+            if not data:
+                return
+            buffer += data
+            # Maintenance runs in this process, and waits for a quiet moment
+            # between client requests rather than app requests
+            scheduler.request_started()
+            try:
+                if not self._answer(buffer):
+                    return
+            finally:
+                scheduler.request_finished()
+
+    def _answer(self, buffer: bytearray) -> bool:
+        """
+        Runs every complete request in buffer, removing them from it, and sends the responses.
+        Returns False if the connection should be dropped.
+        """
+        responses = bytearray()
+        while len(buffer) >= 4:
+            size = _FRAME.unpack_from(buffer)[0]
+            if size < 1 or size > MAX_FRAME:
+                return False
+            if len(buffer) < 4 + size:
+                break
+            body = bytes(buffer[4 : 4 + size])
+            del buffer[: 4 + size]
+            response = self.respond(body)
+            if response is None:
+                return False
+            responses += response
+        if responses:
+            self.request.sendall(responses)
+        return True
+
+    def ok(self, rows: list | None = None, rowcount: int = -1, lastrowid=None) -> bytes:
+        """Builds a success response, telling the client whether a transaction is open."""
+        return pack_frame(
+            STATUS_OK, [rows or [], rowcount, lastrowid, self.db_.in_transaction]
+        )
+
+    def respond(self, body: bytes) -> bytes | None:
+        """
+        Runs one request and builds its response frame.
+        Returns None if the connection should be dropped.
+        """
+        opcode = body[:1]
+        args, _ = decode(memoryview(body), 1)
+
+        if not self.authenticated:
+            if opcode != OP_AUTH or not hmac.compare_digest(
+                str(args[0]).encode(), self.server.token.encode()
+            ):
+                return None
+            self.authenticated = True
+            return self.ok()
+
+        if opcode == OP_RESUME:
+            self.failed = False
+            return self.ok()
+        if self.failed:
+            return pack_frame(STATUS_SKIPPED, [])
+
+        try:
+            if opcode == OP_EXECUTE:
+                cursor = self.db_.execute(args[0], args[1])
+                rows = cursor.fetchall()
+                return self.ok(rows, cursor.rowcount, cursor.lastrowid)
+            if opcode == OP_COMMIT:
+                self.db_.commit()
+            elif opcode == OP_ROLLBACK:
+                self.db_.rollback()
+            else:
+                raise sqlite3.ProgrammingError(f"Unknown request {opcode!r}.")
+            return self.ok()
+        except sqlite3.Error as e:
+            self.failed = True
+            return pack_frame(STATUS_ERROR, [type(e).__name__, str(e)])
+
+
+class _StorageSettings:
+    """What each StorageSession needs from its server, set by make_server()."""
+
+    daemon_threads = True
+    db_path = "database.db"
+    token = ""
+    busy_timeout = 5.0
+
+
+class _TCPServer(_StorageSettings, socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+
+
+class _UnixServer(_StorageSettings, socketserver.ThreadingUnixStreamServer):
+    pass
+
+
+def make_server(
+    listen: str, db_path: str, token: str = "", busy_timeout: float = 5.0
+) -> socketserver.BaseServer:
+    """
+    Builds a server listening on "unix:/path" or "tcp:host:port".
+    Raises ValueError for a TCP address without a token.
+    """
+    family, target = parse_address(listen)
+    if family != socket.AF_UNIX and not token:
+        # Anyone who can connect can run any SQL, so a network listener needs a token
+        raise ValueError("The storage server needs a token to listen on TCP.")
+    if family == socket.AF_UNIX:
+        if os.path.exists(target):
+            os.remove(target)
+        server = _UnixServer(target, StorageSession)
+    else:
+        server = _TCPServer(target, StorageSession)
+    server.db_path = db_path
+    server.token = token
+    server.busy_timeout = busy_timeout
+    return server
+
+
+if __name__ == "__main__":
+    with open("config.json", "r", encoding="utf-8") as f:
+        config = json.load(f)
+    storage_config = config.get("storage", {})
+    db_path = storage_config.get("path", "database.db")
+
+    audit_log.start(config.get("audit"))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        server = make_server(
+            os.environ.get("STORAGE_LISTEN")
+            or storage_config.get("listen", "unix:storage.sock"),
+            db_path,
+            os.environ.get("STORAGE_TOKEN") or storage_config.get("token", ""),
+            storage_config.get("busy_timeout", 5.0),
+        )
+    except ValueError as e:
+        sys.exit(str(e))
+
+    db = sqlite3.connect(db_path)
+    init_db(db)
+    if config["debug_bool"]:
+        seed_db(db)
+    db.close()
+
+    # Maintenance and backups run here, next to the database file
+    scheduler.start(db_path, config.get("maintenance"), config.get("backup"))
+
+    server.serve_forever()
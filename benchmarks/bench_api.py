@@ -0,0 +1,74 @@
+"""
+Benchmarks note edit throughput through the HTML form flow
+(POST, redirect, render /notes), single JSON API calls, and one JSON batch.
+
+Run from the project root: python benchmarks/bench_api.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+# pylint: disable=wrong-import-position,import-error
+import app as notes_app
+from seed_db import init_db
+
+EDITS = 500
+NOTES = 50
+BASE = "https://localhost"
+
+
+def report(name: str, seconds: float) -> None:
+    """Prints the throughput of one flow."""
+    print(f"{name:<28} {EDITS / seconds:>10.0f} edits/s  ({seconds * 1000:.0f} ms total)")
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+    os.chdir(tempfile.mkdtemp())
+    notes_app.limiter.enabled = False
+    with notes_app.app.app_context():
+        init_db(notes_app.get_db())
+
+    client = notes_app.app.test_client()
+    client.post(
+        f"{BASE}/register",
+        data={"username": "benchuser", "password": "benchpass", "password_2": "benchpass"},
+    )
+    client.post(f"{BASE}/login", data={"username": "benchuser", "password": "benchpass"})
+    ids = [
+        client.post(f"{BASE}/api/v1/notes", json={"content": f"note {i}"}).json["id"]
+        for i in range(NOTES)
+    ]
+
+    start = time.perf_counter()
+    for i in range(EDITS):
+        client.post(
+            f"{BASE}/notes/edit/{ids[i % NOTES]}",
+            data={"note_content": f"form edit {i}"},
+            follow_redirects=True,
+        )
+    report("form POST + redirect", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(EDITS):
+        client.put(
+            f"{BASE}/api/v1/notes/{ids[i % NOTES]}", json={"content": f"api edit {i}"}
+        )
+    report("JSON API, one per request", time.perf_counter() - start)
+
+    operations = [
+        {"op": "edit", "id": ids[i % NOTES], "content": f"batch edit {i}"}
+        for i in range(EDITS)
+    ]
+    start = time.perf_counter()
+    response = client.post(f"{BASE}/api/v1/notes/batch", json={"operations": operations})
+    report("JSON API, one batch", time.perf_counter() - start)
+    assert all(result["ok"] for result in response.json["results"])
+
+
+if __name__ == "__main__":
+    main()
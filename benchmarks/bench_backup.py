@@ -0,0 +1,129 @@
+"""
+Benchmarks online backups: how long a backup of a large database takes,
+and the latency of foreground reads and writes before and during the backup.
+
+Run from the project root: python benchmarks/bench_backup.py [--size-mb 2048]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import string
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+# pylint: disable=wrong-import-position,import-error
+from backup import create_backup
+from dal import DAL, PERMISSION_OWNER
+from seed_db import init_db
+
+NOTE_LENGTH = 4000
+BASELINE_SECONDS = 3.0
+
+
+def build_database(path: str, size_mb: int) -> tuple[int, int]:
+    """Fills a database with random notes until it is about size_mb. Returns (user_id, notes)."""
+    db_ = sqlite3.connect(path)
+    init_db(db_)
+    user_id = DAL.create_user(db_, "benchuser", "benchpassword").unwrap()
+    count = size_mb * 1024 * 1024 // NOTE_LENGTH
+    # Random text compresses about as well as real notes, unlike repeated characters
+    alphabet = string.ascii_letters + " \n"
+    for start in range(0, count, 10000):
+        ids = range(start + 1, min(start + 10000, count) + 1)
+        db_.executemany(
+            "INSERT INTO notes (id, user_id, content) VALUES (?, ?, ?)",
+            (
+                (note_id, user_id, "".join(random.choices(alphabet, k=NOTE_LENGTH)))
+                for note_id in ids
+            ),
+        )
+        # The DAL only finds notes the user has a permission row for
+        db_.executemany(
+            "INSERT INTO note_permissions (note_id, user_id, level) VALUES (?, ?, ?)",
+            ((note_id, user_id, PERMISSION_OWNER) for note_id in ids),
+        )
+        db_.commit()
+    db_.close()
+    return user_id, count
+
+
+def foreground(path, user_id, notes, stop, latencies):
+    """Reads random notes, editing every 20th, recording each call's latency."""
+    db_ = sqlite3.connect(path)
+    i = 0
+    while not stop.is_set():
+        note_id = random.randint(1, notes)
+        start = time.perf_counter()
+        if i % 20 == 0:
+            DAL.edit_note(db_, note_id, user_id, f"edit {i}").unwrap()
+        else:
+            DAL.get_note_by_id(db_, note_id, user_id).unwrap()
+        latencies.append((time.perf_counter() - start) * 1000)
+        i += 1
+    db_.close()
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Returns the pct percentile of values."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run_foreground(path, user_id, notes, work) -> list[float]:
+    """Runs foreground traffic for as long as work() takes, returning its latencies."""
+    latencies: list[float] = []
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=foreground, args=(path, user_id, notes, stop, latencies)
+    )
+    thread.start()
+    work()
+    stop.set()
+    thread.join()
+    return latencies
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=256)
+    args = parser.parse_args()
+
+    random.seed(0)
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, "database.db")
+    print(f"building a {args.size_mb} MB database in {workdir} ...")
+    user_id, notes = build_database(path, args.size_mb)
+
+    baseline = run_foreground(path, user_id, notes, lambda: time.sleep(BASELINE_SECONDS))
+
+    config = {"dir": os.path.join(workdir, "backups")}
+    result = {}
+
+    def backup():
+        src = sqlite3.connect(path)
+        start = time.perf_counter()
+        result["path"] = create_backup(src, config).unwrap()
+        result["seconds"] = time.perf_counter() - start
+        src.close()
+
+    during = run_foreground(path, user_id, notes, backup)
+
+    print(f"database size:      {os.path.getsize(path) / 1024 / 1024:.0f} MB")
+    print(f"backup size:        {os.path.getsize(result['path']) / 1024 / 1024:.0f} MB")
+    print(f"backup duration:    {result['seconds']:.1f} s")
+    for name, latencies in (("baseline", baseline), ("during backup", during)):
+        print(
+            f"{name:<18}  p50 {percentile(latencies, 50):.3f} ms"
+            f"  p99 {percentile(latencies, 99):.3f} ms  ({len(latencies)} calls)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmarks note permission checks for a user holding 100k grants:
+uncached checks, checks answered by the per-request cache,
+and the "shared with me" listing.
+
+Run from the project root: python benchmarks/bench_permissions.py
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+# pylint: disable=wrong-import-position,import-error
+from dal import DAL, PERMISSION_EDIT, PERMISSION_OWNER, PERMISSION_READ
+from seed_db import init_db
+
+GRANTS = 100_000
+CHECKS = 20_000
+
+
+def build_database(path: str) -> tuple[int, int]:
+    """Shares GRANTS notes from one user with another. Returns (owner_id, reader_id)."""
+    db_ = sqlite3.connect(path)
+    init_db(db_)
+    owner_id = DAL.create_user(db_, "benchowner", "benchpassword").unwrap()
+    reader_id = DAL.create_user(db_, "benchreader", "benchpassword").unwrap()
+    db_.executemany(
+        "INSERT INTO notes (id, user_id, content) VALUES (?, ?, ?)",
+        ((i, owner_id, f"note {i}") for i in range(1, GRANTS + 1)),
+    )
+    db_.executemany(
+        "INSERT INTO note_permissions (note_id, user_id, level) VALUES (?, ?, ?)",
+        ((i, owner_id, PERMISSION_OWNER) for i in range(1, GRANTS + 1)),
+    )
+    db_.executemany(
+        "INSERT INTO note_permissions (note_id, user_id, level) VALUES (?, ?, ?)",
+        (
+            (i, reader_id, PERMISSION_EDIT if i % 2 else PERMISSION_READ)
+            for i in range(1, GRANTS + 1)
+        ),
+    )
+    db_.commit()
+    db_.execute("ANALYZE")
+    db_.close()
+    return owner_id, reader_id
+
+
+def time_per_call(call, calls: int) -> float:
+    """Returns the mean microseconds per call."""
+    start = time.perf_counter()
+    for _ in range(calls):
+        call()
+    return (time.perf_counter() - start) / calls * 1_000_000
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+    random.seed(0)
+    path = os.path.join(tempfile.mkdtemp(), "database.db")
+    _, reader_id = build_database(path)
+    db_ = sqlite3.connect(path)
+    note_ids = [random.randint(1, GRANTS) for _ in range(CHECKS)]
+    ids = iter(note_ids * 3)
+
+    uncached = time_per_call(
+        lambda: DAL.get_note_by_id(db_, next(ids), reader_id).unwrap(), CHECKS
+    )
+
+    cache: dict = {}
+    for note_id in note_ids:
+        DAL.get_note_by_id(db_, note_id, reader_id, cache)
+    cached = time_per_call(
+        lambda: DAL.get_note_by_id(db_, next(ids), reader_id, cache).unwrap(), CHECKS
+    )
+    level_only = time_per_call(
+        lambda: DAL.get_permission(db_, next(ids), reader_id, cache).unwrap(), CHECKS
+    )
+
+    start = time.perf_counter()
+    shared = DAL.get_notes_shared_with_user(db_, reader_id).unwrap()
+    listing_ms = (time.perf_counter() - start) * 1000
+
+    plan = db_.execute(
+        """
+        EXPLAIN QUERY PLAN
+        SELECT n.id, n.content, p.level
+        FROM note_permissions p
+        JOIN notes n ON n.id = p.note_id
+        WHERE p.user_id = ? AND p.note_id = ?
+        """,
+        (reader_id, 1),
+    ).fetchall()
+
+    print(f"grants held by reader:           {GRANTS}")
+    print(f"get_note_by_id, uncached check:  {uncached:.1f} us")
+    print(f"get_note_by_id, cached check:    {cached:.1f} us")
+    print(f"get_permission, cached:          {level_only:.1f} us")
+    print(f"shared with me listing:          {listing_ms:.0f} ms for {len(shared)} notes")
+    print("permission join plan:")
+    for row in plan:
+        print(f"    {row[-1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmarks the note revision history:
+write amplification of delta storage compared to full copies,
+and reconstruction latency of the oldest and newest revisions at depth 1000.
+
+Run from the project root: python benchmarks/bench_revisions.py
+"""
+
+import os
+import random
+import sqlite3
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+# pylint: disable=wrong-import-position,import-error
+from dal import DAL
+from seed_db import init_db
+
+DEPTH = 1000
+NOTE_LENGTH = 4000
+REPEATS = 200
+
+
+def random_edit(content: str) -> str:
+    """Replaces a short random span of the note, like a typical small edit."""
+    start = random.randrange(len(content))
+    end = min(len(content), start + random.randint(0, 40))
+    insert = "".join(random.choices(string.ascii_letters + " ", k=random.randint(1, 40)))
+    return (content[:start] + insert + content[end:])[:NOTE_LENGTH]
+
+
+def time_rebuild(db_, note_id: int, user_id: int, revision: int) -> float:
+    """Returns the mean latency in milliseconds of rebuilding a revision."""
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        DAL.get_note_revision(db_, note_id, user_id, revision).unwrap()
+    return (time.perf_counter() - start) / REPEATS * 1000
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+    random.seed(0)
+    db_ = sqlite3.connect(":memory:")
+    init_db(db_)
+    user_id = DAL.create_user(db_, "benchuser", "benchpassword").unwrap()
+
+    content = "".join(random.choices(string.ascii_letters + " \n", k=NOTE_LENGTH))
+    note_id = DAL.create_note_for_user(db_, user_id, content).unwrap()
+    full_copy_bytes = len(content.encode())
+
+    start = time.perf_counter()
+    for _ in range(DEPTH):
+        new_content = random_edit(content)
+        DAL.edit_note(db_, note_id, user_id, new_content).unwrap()
+        full_copy_bytes += len(new_content.encode())
+        content = new_content
+    write_ms = (time.perf_counter() - start) / DEPTH * 1000
+
+    stored_bytes = db_.execute(
+        "SELECT SUM(LENGTH(CAST(payload AS BLOB))) FROM note_revisions WHERE note_id = ?",
+        (note_id,),
+    ).fetchone()[0]
+
+    print(f"revisions written:           {DEPTH + 1}")
+    print(f"mean edit latency:           {write_ms:.3f} ms")
+    print(f"history bytes, full copies:  {full_copy_bytes}")
+    print(f"history bytes, deltas:       {stored_bytes}")
+    print(f"write amplification vs copy: {stored_bytes / full_copy_bytes:.3f}")
+    print(f"bytes stored per edit:       {stored_bytes / (DEPTH + 1):.1f}")
+    print(f"rebuild revision 0:          {time_rebuild(db_, note_id, user_id, 0):.3f} ms")
+    print(f"rebuild revision {DEPTH - 1}:       "
+          f"{time_rebuild(db_, note_id, user_id, DEPTH - 1):.3f} ms")
+    print(f"rebuild revision {DEPTH}:       "
+          f"{time_rebuild(db_, note_id, user_id, DEPTH):.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
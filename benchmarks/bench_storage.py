@@ -0,0 +1,126 @@
+"""
+Benchmarks request throughput with 1, 2, 4 and 8 app nodes sharing one storage
+daemon, next to a single node on a local database file.
+
+Each node is a separate process serving a mix of JSON API reads and edits
+(READ_SHARE reads) through Flask's test client, so the numbers include routing,
+sessions and the DAL but not TLS or HTTP parsing. All processes share this
+machine's cores, so expect scaling to flatten once nodes outnumber them.
+
+Run from the project root: python benchmarks/bench_storage.py [--seconds 5]
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+# pylint: disable=wrong-import-position,import-error
+from seed_db import init_db
+from storage import RemoteBackend, SqliteBackend
+from storage_server import make_server
+
+NODE_COUNTS = (1, 2, 4, 8)
+NOTES_PER_NODE = 50
+READ_SHARE = 0.8
+BASE = "https://localhost"
+
+
+def run_server(listen: str, db_path: str) -> None:
+    """Runs the storage daemon until the process is terminated."""
+    make_server(listen, db_path).serve_forever()
+
+
+def run_node(backend, node: int, seconds: float, barrier, results) -> None:
+    """Serves requests as one app node for a fixed time, reporting how many it served."""
+    # pylint: disable=import-outside-toplevel
+    import app as notes_app
+
+    notes_app.storage_backend = backend
+    notes_app.limiter.enabled = False
+    client = notes_app.app.test_client()
+    name = f"benchnode{node}x{os.getpid()}"
+    client.post(
+        f"{BASE}/register",
+        data={"username": name, "password": "benchpass", "password_2": "benchpass"},
+    )
+    client.post(f"{BASE}/login", data={"username": name, "password": "benchpass"})
+    ids = [
+        client.post(f"{BASE}/api/v1/notes", json={"content": f"note {i}"}).json["id"]
+        for i in range(NOTES_PER_NODE)
+    ]
+    rng = random.Random(node)
+
+    barrier.wait()
+    requests = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        note_id = rng.choice(ids)
+        if rng.random() < READ_SHARE:
+            response = client.get(f"{BASE}/api/v1/notes/{note_id}")
+        else:
+            response = client.put(
+                f"{BASE}/api/v1/notes/{note_id}", json={"content": f"edit {requests}"}
+            )
+        assert response.status_code == 200, response.json
+        requests += 1
+    results.put(requests)
+
+
+def measure(make_backend, nodes: int, seconds: float) -> float:
+    """Runs nodes app processes at once, returning their total requests per second."""
+    barrier = multiprocessing.Barrier(nodes)
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=run_node, args=(make_backend(), node, seconds, barrier, results)
+        )
+        for node in range(nodes)
+    ]
+    for worker in workers:
+        worker.start()
+    total = sum(results.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+    return total / seconds
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    db_path = os.path.abspath("database.db")
+    db_ = sqlite3.connect(db_path)
+    init_db(db_)
+    db_.close()
+
+    print(f"cores: {os.cpu_count()}, {args.seconds} s per run, {READ_SHARE:.0%} reads")
+    local = measure(lambda: SqliteBackend(db_path), 1, args.seconds)
+    print(f"{'local sqlite, 1 node':<24} {local:>10.0f} requests/s")
+
+    address = "unix:" + os.path.abspath("store.sock")
+    server = multiprocessing.Process(target=run_server, args=(address, db_path), daemon=True)
+    server.start()
+    while not os.path.exists("store.sock"):
+        time.sleep(0.05)
+
+    try:
+        for nodes in NODE_COUNTS:
+            throughput = measure(lambda: RemoteBackend(address), nodes, args.seconds)
+            label = f"storage daemon, {nodes} node{'s' if nodes > 1 else ''}"
+            print(f"{label:<24} {throughput:>10.0f} requests/s")
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+"""
+Memory profiling harness for the DAL, validators and routes.
+
+Calls each target thousands of times under tracemalloc and reports, per call:
+    peak   - the most memory the call had allocated at once, i.e. its allocation churn
+    kept   - memory still held after all calls finished, divided by the number of calls
+Then compares both against memory_baseline.json and exits non-zero on a regression.
+
+Run from the project root:
+    python benchmarks/profile_memory.py                    # check against the baseline
+    python benchmarks/profile_memory.py --update-baseline  # record a new baseline
+    python benchmarks/profile_memory.py --live <pid>       # dump a running app's top allocators
+"""
+
+import argparse
+import gc
+import json
+import os
+import signal
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+# pylint: disable=wrong-import-position,import-error
+import app as notes_app
+import memprofile
+from dal import DAL, PERMISSION_EDIT, PERMISSION_READ
+from revisions import DEFAULT_RETAINED_REVISIONS
+from seed_db import init_db
+from validators import validate_note, validate_registration
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "memory_baseline.json")
+ITERATIONS = 2000
+# Password hashing makes these far slower than everything else
+SLOW_ITERATIONS = 20
+NOTES_PER_USER = 50
+SHARED_NOTES = 10
+BASE = "https://localhost"
+# How long --live waits for the app to write its dump
+DUMP_TIMEOUT = 120
+
+
+def measure(call, iterations: int) -> dict:
+    """Runs call iterations times, returning its peak and retained bytes per call."""
+    # Warm up caches, lazily built objects and the like, so they don't count as leaks
+    for _ in range(min(iterations, 20)):
+        call()
+    gc.collect()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    peak_total = 0
+    for _ in range(iterations):
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+        peak_total += peak - start
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    growth = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return {
+        "peak_per_call": peak_total / iterations,
+        "kept_per_call": max(growth, 0) / iterations,
+    }
+
+
+def build_targets():
+    """Sets up a scratch database and returns {name: (call, iterations)}."""
+    os.chdir(tempfile.mkdtemp())
+    db_ = sqlite3.connect("database.db")
+    init_db(db_)
+    user_id = DAL.create_user(db_, "profileuser", "profilepass").unwrap()
+    for i in range(NOTES_PER_USER):
+        DAL.create_note_for_user(db_, user_id, f"note {i} " * 20)
+    note_id = 1
+    # A note with two revisions to read back and restore
+    history_note_id = DAL.create_note_for_user(db_, user_id, "first revision").unwrap()
+    DAL.edit_note(db_, history_note_id, user_id, "second revision")
+    # A second user with some of those notes shared with them
+    sharee_id = DAL.create_user(db_, "shareeuser", "shareepass").unwrap()
+    for shared_id in range(1, SHARED_NOTES + 1):
+        DAL.share_note(db_, shared_id, user_id, "shareeuser", PERMISSION_READ)
+    counter = iter(range(10**9))
+
+    def create_and_delete():
+        new_id = DAL.create_note_for_user(db_, user_id, "scratch note").unwrap()
+        DAL.delete_note(db_, new_id, user_id)
+
+    def share_and_unshare():
+        DAL.share_note(db_, note_id, user_id, "shareeuser", PERMISSION_EDIT)
+        DAL.unshare_note(db_, note_id, user_id, sharee_id)
+
+    def batch():
+        return [("edit", note_id, f"batch edit {next(counter)}") for _ in range(10)]
+
+    notes_app.limiter.enabled = False
+    client = notes_app.app.test_client()
+    client.post(f"{BASE}/login", data={"username": "profileuser", "password": "profilepass"})
+
+    # Registering needs a client that is not logged in, or /register just redirects
+    anonymous = notes_app.app.test_client()
+
+    def register():
+        name = f"newuser{next(counter)}"
+        anonymous.post(
+            f"{BASE}/register",
+            data={"username": name, "password": "newpassword", "password_2": "newpassword"},
+        )
+
+    def delete_route():
+        # The note to delete is made through the DAL, which is measured too
+        new_id = DAL.create_note_for_user(db_, user_id, "scratch note").unwrap()
+        client.post(f"{BASE}/notes/delete/{new_id}")
+
+    def logout():
+        # Logging in again through /login would mostly measure password hashing
+        with logged_out.session_transaction() as session:
+            session["user_id"] = user_id
+        logged_out.post(f"{BASE}/logout")
+
+    logged_out = notes_app.app.test_client()
+
+    def unshare_route():
+        # The grant to take away is made through the DAL, which is measured too
+        DAL.share_note(db_, note_id, user_id, "shareeuser", PERMISSION_EDIT)
+        client.post(f"{BASE}/notes/unshare/{note_id}/{sharee_id}")
+
+    sharee = notes_app.app.test_client()
+    with sharee.session_transaction() as session:
+        session["user_id"] = sharee_id
+
+    return {
+        "dal.find_user_by_id": (lambda: DAL.find_user_by_id(db_, user_id), ITERATIONS),
+        "dal.find_user_by_username": (
+            lambda: DAL.find_user_by_username(db_, "profileuser"),
+            ITERATIONS,
+        ),
+        "dal.get_note_by_id": (
+            lambda: DAL.get_note_by_id(db_, note_id, user_id),
+            ITERATIONS,
+        ),
+        "dal.get_notes_for_user": (
+            lambda: DAL.get_notes_for_user(db_, user_id),
+            ITERATIONS,
+        ),
+        "dal.edit_note": (
+            lambda: DAL.edit_note(db_, note_id, user_id, f"edit {next(counter)}"),
+            ITERATIONS,
+        ),
+        "dal.create_and_delete_note": (create_and_delete, ITERATIONS),
+        "dal.get_note_history": (
+            lambda: DAL.get_note_history(db_, note_id, user_id),
+            ITERATIONS,
+        ),
+        "dal.get_note_revision": (
+            lambda: DAL.get_note_revision(db_, history_note_id, user_id, 1),
+            ITERATIONS,
+        ),
+        "dal.restore_note_revision": (
+            lambda: DAL.restore_note_revision(
+                db_, history_note_id, user_id, next(counter) % 2
+            ),
+            ITERATIONS,
+        ),
+        "dal.apply_note_batch": (
+            lambda: DAL.apply_note_batch(db_, user_id, batch()),
+            ITERATIONS,
+        ),
+        "dal.compact_history": (
+            lambda: DAL.compact_history(db_, DEFAULT_RETAINED_REVISIONS),
+            ITERATIONS,
+        ),
+        "dal.get_notes_shared_with_user": (
+            lambda: DAL.get_notes_shared_with_user(db_, sharee_id),
+            ITERATIONS,
+        ),
+        "dal.get_note_grants": (
+            lambda: DAL.get_note_grants(db_, note_id, user_id),
+            ITERATIONS,
+        ),
+        "dal.share_and_unshare_note": (share_and_unshare, ITERATIONS),
+        "dal.create_user": (
+            lambda: DAL.create_user(db_, f"daluser{next(counter)}", "dalpassword"),
+            SLOW_ITERATIONS,
+        ),
+        "dal.update_password": (
+            lambda: DAL.update_password(db_, user_id, "profilepass", "profilepass"),
+            SLOW_ITERATIONS,
+        ),
+        "validators.validate_note": (lambda: validate_note("a note " * 50), ITERATIONS),
+        "validators.validate_registration": (
+            lambda: validate_registration("bad", "short", "different"),
+            ITERATIONS,
+        ),
+        "route.GET /": (lambda: client.get(f"{BASE}/"), ITERATIONS),
+        "route.GET /notes": (lambda: client.get(f"{BASE}/notes"), ITERATIONS),
+        "route.GET /notes/edit": (
+            lambda: client.get(f"{BASE}/notes/edit/{note_id}"),
+            ITERATIONS,
+        ),
+        "route.POST /notes/edit": (
+            lambda: client.post(
+                f"{BASE}/notes/edit/{note_id}",
+                data={"note_content": f"form edit {next(counter)}"},
+                follow_redirects=True,
+            ),
+            ITERATIONS,
+        ),
+        "route.GET /api/v1/notes": (
+            lambda: client.get(f"{BASE}/api/v1/notes"),
+            ITERATIONS,
+        ),
+        "route.GET /notes/new": (lambda: client.get(f"{BASE}/notes/new"), ITERATIONS),
+        "route.POST /notes/new": (
+            lambda: client.post(
+                f"{BASE}/notes/new", data={"note_content": f"new note {next(counter)}"}
+            ),
+            ITERATIONS,
+        ),
+        "route.POST /notes/delete": (delete_route, ITERATIONS),
+        "route.GET /notes/history": (
+            lambda: client.get(f"{BASE}/notes/history/{history_note_id}"),
+            ITERATIONS,
+        ),
+        "route.POST /notes/restore": (
+            lambda: client.post(
+                f"{BASE}/notes/restore/{history_note_id}/{next(counter) % 2}"
+            ),
+            ITERATIONS,
+        ),
+        "route.POST /api/v1/notes/batch": (
+            lambda: client.post(
+                f"{BASE}/api/v1/notes/batch",
+                json={
+                    "operations": [
+                        {"op": op, "id": target, "content": content}
+                        for op, target, content in batch()
+                    ]
+                },
+            ),
+            ITERATIONS,
+        ),
+        "route.GET /notes/share": (
+            lambda: client.get(f"{BASE}/notes/share/{note_id}"),
+            ITERATIONS,
+        ),
+        "route.POST /notes/share": (
+            lambda: client.post(
+                f"{BASE}/notes/share/{note_id}",
+                data={"username": "shareeuser", "level": "read"},
+            ),
+            ITERATIONS,
+        ),
+        "route.POST /notes/unshare": (unshare_route, ITERATIONS),
+        "route.GET /notes shared": (lambda: sharee.get(f"{BASE}/notes"), ITERATIONS),
+        "route.GET /api/v1/notes/shared": (
+            lambda: sharee.get(f"{BASE}/api/v1/notes/shared"),
+            ITERATIONS,
+        ),
+        "route.POST /logout": (logout, ITERATIONS),
+        "route.GET /notes anonymous": (
+            lambda: anonymous.get(f"{BASE}/notes", follow_redirects=True),
+            ITERATIONS,
+        ),
+        "route.POST /register": (register, SLOW_ITERATIONS),
+        "route.POST /login": (
+            lambda: anonymous.post(
+                f"{BASE}/login", data={"username": "profileuser", "password": "wrong"}
+            ),
+            SLOW_ITERATIONS,
+        ),
+    }
+
+
+def exceeds(measured: float, baseline: float, tolerance: float, slack: float) -> bool:
+    """Whether a measurement regressed past its baseline."""
+    return measured > baseline * (1 + tolerance) + slack
+
+
+def live(pid: int, dump_dir: str, seconds: float) -> None:
+    """Starts tracing in a running app, waits, then prints what it dumped."""
+    path = memprofile.dump_path(pid, dump_dir)
+    # Dumps are appended, only print the one taken now
+    start = os.path.getsize(path) if os.path.exists(path) else 0
+    os.kill(pid, signal.SIGUSR1)
+    print(f"tracing {pid} for {seconds} s ...")
+    time.sleep(seconds)
+    os.kill(pid, signal.SIGUSR1)
+    # The app dumps from a thread, and stopping tracing before it has taken its
+    # snapshot would lose the dump, so wait for it to be written first
+    dump = wait_for_dump(path, start, DUMP_TIMEOUT)
+    os.kill(pid, signal.SIGUSR2)
+    if dump is None:
+        sys.exit(f"No dump was written to {path} within {DUMP_TIMEOUT} s.")
+    print(dump)
+
+
+def wait_for_dump(path: str, start: int, timeout: float) -> str | None:
+    """
+    Waits for a complete dump to be appended to path after offset start.
+    Returns it, or None if none was written within timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.path.exists(path) and os.path.getsize(path) > start:
+            with open(path, "r", encoding="utf-8") as f:
+                f.seek(start)
+                dump = f.read()
+            # Each dump ends with a blank line
+            if dump.endswith("\n\n"):
+                return dump
+        time.sleep(0.1)
+    return None
+
+
+def main():
+    """Runs the harness."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--slack", type=float, default=64, help="bytes allowed over baseline")
+    parser.add_argument("--live", type=int, metavar="PID")
+    parser.add_argument("--dump-dir", default=".")
+    parser.add_argument("--seconds", type=float, default=30)
+    args = parser.parse_args()
+
+    if args.live:
+        live(args.live, args.dump_dir, args.seconds)
+        return
+
+    results = {}
+    for name, (call, iterations) in build_targets().items():
+        results[name] = measure(call, iterations)
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(
+                {k: {m: round(v) for m, v in r.items()} for k, r in results.items()},
+                f,
+                indent=2,
+            )
+            f.write("\n")
+        print(f"Wrote {BASELINE_PATH}")
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    failed = []
+    print(f"{'target':<34} {'peak B/call':>12} {'kept B/call':>12}")
+    for name, result in results.items():
+        expected = baseline.get(name)
+        flag = ""
+        if expected and any(
+            exceeds(result[m], expected[m], args.tolerance, args.slack) for m in result
+        ):
+            flag = "  REGRESSED"
+            failed.append(name)
+        print(
+            f"{name:<34} {result['peak_per_call']:>12.0f}"
+            f" {result['kept_per_call']:>12.1f}{flag}"
+        )
+
+    if failed:
+        sys.exit(f"Memory use regressed past the baseline for: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
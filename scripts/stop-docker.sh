@@ -1 +1,5 @@
-sudo docker compose down
+# docker-compose.yml needs these secrets, make throwaway ones if they aren't set
+export SECRET_KEY="${SECRET_KEY:-$(python3 -c 'import secrets; print(secrets.token_hex(32))')}"
+export STORAGE_TOKEN="${STORAGE_TOKEN:-$(python3 -c 'import secrets; print(secrets.token_hex(32))')}"
+
+sudo --preserve-env=SECRET_KEY,STORAGE_TOKEN docker compose down
@@ -1,9 +1,13 @@
 # Exit if any command fails
 set -e
 
+# docker-compose.yml needs these secrets, make throwaway ones if they aren't set
+export SECRET_KEY="${SECRET_KEY:-$(python3 -c 'import secrets; print(secrets.token_hex(32))')}"
+export STORAGE_TOKEN="${STORAGE_TOKEN:-$(python3 -c 'import secrets; print(secrets.token_hex(32))')}"
+
 cleanup() {
     echo "--- Shutting down containers ---"
-    sudo docker compose down
+    sudo --preserve-env=SECRET_KEY,STORAGE_TOKEN docker compose down
 }
 
 # make cleanup function get called on script exit
@@ -23,19 +27,19 @@ pylint --load-plugins pylint_pytest --fail-under=6.0 tests/*.py
 
 echo "--- Building Docker image ---"
 # 'build' uses your Dockerfile and docker-compose.yml to build the image
-sudo docker compose build
+sudo --preserve-env=SECRET_KEY,STORAGE_TOKEN docker compose build
 
 echo "--- starting container in background ---"
 # up -d starts it detached 
-sudo docker compose up -d
+sudo --preserve-env=SECRET_KEY,STORAGE_TOKEN docker compose up -d
 
 echo "--- spinning up the app ---"
 sleep 4
 
 echo "--- testing with pytest ---"
-pytest ./tests/integration_tests.py
+pytest ./tests/unit_tests.py ./tests/integration_tests.py
 
 echo "--- All steps passed successfully! ---"
 echo "---"
 echo "Now running in the background"
-echo "To stop it, run: sudo docker compose down"
+echo "To stop it, run: sh scripts/stop-docker.sh"
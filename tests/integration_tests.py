@@ -1,4 +1,5 @@
 import json
+import uuid
 import pytest
 import requests
 
@@ -19,6 +20,10 @@ def base_url():
     return f"https://{host}:{port}"
 
 
+# Request options for the test server's self-signed certificate
+NO_VERIFY = {"verify": False, "timeout": 4}
+
+
 # HAPPY PATH TESTS
 
 
@@ -40,9 +45,84 @@ def test_get_all_notes_endpoint_no_authentication(base_url):
     assert response.url != base_url
 
 
+def test_note_history_endpoint_no_authentication(base_url):
+    """
+    Tests that the GET /notes/history endpoint redirects users to /login if
+    they're not authenticated
+    """
+    response = get_no_verify(f"{base_url}/notes/history/1")
+    assert response.history  # exists
+    assert response.status_code == 200
+    assert response.url.endswith("/login")
+
+
 # SAD PATH TESTING
 
 
+def logged_in_session(base_url, role):
+    """
+    Registers a new user and returns a requests.Session logged in as them,
+    along with their username
+    """
+    username = f"{role}_{uuid.uuid4().hex[:12]}"
+    password = "integration-pass"
+    session = requests.Session()
+    session.post(
+        f"{base_url}/register",
+        data={"username": username, "password": password, "password_2": password},
+        **NO_VERIFY,
+    )
+    session.post(
+        f"{base_url}/login",
+        data={"username": username, "password": password},
+        **NO_VERIFY,
+    )
+    return session, username
+
+
+def test_shared_note_permissions(base_url):
+    """
+    Tests that a reader can view a shared note but not edit or delete it,
+    and that an editor who isn't the owner can't share it any further
+    """
+    owner, _ = logged_in_session(base_url, "owner")
+    reader, reader_name = logged_in_session(base_url, "reader")
+    editor, editor_name = logged_in_session(base_url, "editor")
+    outsider, outsider_name = logged_in_session(base_url, "outsider")
+
+    response = owner.post(
+        f"{base_url}/api/v1/notes", json={"content": "owned note"}, **NO_VERIFY
+    )
+    assert response.status_code == 201
+    note_url = f"{base_url}/api/v1/notes/{response.json()['id']}"
+    share_url = f"{base_url}/notes/share/{response.json()['id']}"
+    owner.post(share_url, data={"username": reader_name, "level": "read"}, **NO_VERIFY)
+    owner.post(share_url, data={"username": editor_name, "level": "edit"}, **NO_VERIFY)
+
+    assert reader.get(note_url, **NO_VERIFY).status_code == 200
+    response = reader.put(note_url, json={"content": "reader edit"}, **NO_VERIFY)
+    assert response.status_code == 404
+    assert reader.delete(note_url, **NO_VERIFY).status_code == 404
+    assert owner.get(note_url, **NO_VERIFY).json()["content"] == "owned note"
+
+    editor.post(
+        share_url, data={"username": outsider_name, "level": "edit"}, **NO_VERIFY
+    )
+    assert outsider.get(note_url, **NO_VERIFY).status_code == 404
+    assert editor.delete(note_url, **NO_VERIFY).status_code == 404
+    assert owner.get(note_url, **NO_VERIFY).status_code == 200
+
+
+def test_api_notes_endpoint_no_authentication(base_url):
+    """
+    Tests that the GET /api/v1/notes endpoint returns a JSON 401 if
+    the user is not authenticated
+    """
+    response = get_no_verify(f"{base_url}/api/v1/notes")
+    assert response.status_code == 401
+    assert "error" in response.json()
+
+
 def test_no_http(base_url):
     """
     Tests that the site is unreachable on http
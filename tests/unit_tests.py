@@ -0,0 +1,598 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import pytest
+from returns.result import Failure, Success
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+# pylint: disable=wrong-import-position,import-error
+from audit import AuditLog, audit_log
+from backup import (
+    create_backup,
+    list_backups,
+    pick_backup,
+    prune_backups,
+    restore_backup,
+    verify_backup,
+)
+from dal import DAL, PERMISSION_READ
+from maintenance import Scheduler
+from revisions import SNAPSHOT_INTERVAL, apply_delta, make_delta
+from seed_db import init_db
+from storage import RemoteBackend, RemoteConnection, decode, encode
+from storage_server import make_server
+
+STORAGE_TOKEN = "unit-test-token"
+
+
+@pytest.fixture
+def db(tmp_path):
+    """
+    Provides a connection to a fresh database with the app's schema.
+    """
+    db_ = sqlite3.connect(tmp_path / "database.db")
+    init_db(db_)
+    yield db_
+    db_.close()
+
+
+@pytest.fixture
+def user_id(db):
+    """
+    Creates a user to own notes in the test database.
+    """
+    return DAL.create_user(db, "unituser", "unitpassword").unwrap()
+
+
+def wait_until(condition, timeout=5.0):
+    """
+    Polls condition until it is true, failing the test after timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+# NOTE HISTORY
+
+
+@pytest.mark.parametrize(
+    "old, new",
+    [
+        ("", ""),
+        ("", "new note"),
+        ("old note", ""),
+        ("hello world", "hello brave new world"),
+        ("aaaa", "aa"),
+        ("abcabc", "cbacba"),
+        ("snowman ☃ here", "snowman ☃☃ there"),
+    ],
+)
+def test_delta_round_trip(old, new):
+    """
+    Tests that applying the delta between two texts to the first gives the second
+    """
+    assert apply_delta(old, make_delta(old, new)) == new
+
+
+def edit_many_times(db_, owner_id, count):
+    """
+    Creates a note and edits it count times, returning its id and every
+    version of its content, where version i is revision i
+    """
+    versions = ["version 0"]
+    note_id = DAL.create_note_for_user(db_, owner_id, versions[0]).unwrap()
+    for i in range(1, count + 1):
+        versions.append(f"version {i}, with {'more ' * (i % 7)}text")
+        DAL.edit_note(db_, note_id, owner_id, versions[-1]).unwrap()
+    return note_id, versions
+
+
+def test_revisions_rebuild_across_snapshots(db, user_id):
+    """
+    Tests that every revision rebuilds to the content it was saved with,
+    on both sides of a snapshot
+    """
+    note_id, versions = edit_many_times(db, user_id, SNAPSHOT_INTERVAL + 5)
+    kinds = dict(
+        db.execute(
+            "SELECT revision, kind FROM note_revisions WHERE note_id = ?", (note_id,)
+        ).fetchall()
+    )
+    assert kinds[0] == kinds[SNAPSHOT_INTERVAL] == "snapshot"
+    assert kinds[SNAPSHOT_INTERVAL - 1] == kinds[SNAPSHOT_INTERVAL + 1] == "delta"
+    for revision, content in enumerate(versions):
+        assert DAL.get_note_revision(db, note_id, user_id, revision).unwrap() == content
+    res = DAL.get_note_revision(db, note_id, user_id, len(versions))
+    assert res.failure() == "That revision of the note does not exist."
+
+
+def test_compact_history_keeps_newest_revisions_rebuildable(db, user_id):
+    """
+    Tests that compaction drops the oldest revisions, and that the ones it keeps,
+    starting with the cutoff that loses its earlier deltas, still rebuild
+    """
+    note_id, versions = edit_many_times(db, user_id, 30)
+
+    assert DAL.compact_history(db, 10).unwrap() == 21
+    revisions, _ = DAL.get_note_history(db, note_id, user_id).unwrap()
+    assert [revision for revision, _ in revisions] == list(range(30, 20, -1))
+    for revision in range(21, 31):
+        assert DAL.get_note_revision(db, note_id, user_id, revision).unwrap() == (
+            versions[revision]
+        )
+    assert isinstance(DAL.get_note_revision(db, note_id, user_id, 20), Failure)
+    # Nothing more to remove the second time
+    assert DAL.compact_history(db, 10).unwrap() == 0
+    assert isinstance(DAL.compact_history(db, 0), Failure)
+
+
+def test_restore_saves_old_content_as_a_new_revision(db, user_id):
+    """
+    Tests that restoring a revision brings its content back as the newest revision,
+    and that only users who can edit the note may restore it
+    """
+    note_id, versions = edit_many_times(db, user_id, 3)
+    reader_id = DAL.create_user(db, "unitreader", "unitpassword").unwrap()
+    DAL.share_note(db, note_id, user_id, "unitreader", PERMISSION_READ).unwrap()
+
+    assert isinstance(DAL.restore_note_revision(db, note_id, reader_id, 1), Failure)
+    assert isinstance(DAL.restore_note_revision(db, note_id, user_id, 7), Failure)
+
+    DAL.restore_note_revision(db, note_id, user_id, 1).unwrap()
+    assert DAL.get_note_by_id(db, note_id, user_id).unwrap()[1] == versions[1]
+    assert DAL.get_note_revision(db, note_id, user_id, 4).unwrap() == versions[1]
+    # The restore itself can be undone
+    DAL.restore_note_revision(db, note_id, user_id, 3).unwrap()
+    assert DAL.get_note_by_id(db, note_id, user_id).unwrap()[1] == versions[3]
+
+
+def test_concurrent_edits_keep_history_consistent(db, user_id, tmp_path):
+    """
+    Tests that an edit started while another is uncommitted waits for it before
+    reading the note, so its revision is saved against the content it replaces
+    """
+    note_id = DAL.create_note_for_user(db, user_id, "hello world").unwrap()
+    # The first edit holds the write lock until it commits
+    DAL.edit_note(db, note_id, user_id, "HELLO WORLD, edited by A", commit=False).unwrap()
+
+    results = []
+
+    def edit_from_other_connection():
+        other = sqlite3.connect(tmp_path / "database.db")
+        results.append(DAL.edit_note(other, note_id, user_id, "hello world from B"))
+        other.close()
+
+    thread = threading.Thread(target=edit_from_other_connection)
+    thread.start()
+    # Give the second edit time to read the note, if it isn't made to wait
+    time.sleep(0.3)
+    db.commit()
+    thread.join()
+
+    assert isinstance(results[0], Success)
+    assert DAL.get_note_by_id(db, note_id, user_id).unwrap()[1] == "hello world from B"
+    revisions, _ = DAL.get_note_history(db, note_id, user_id).unwrap()
+    assert [revision for revision, _ in revisions] == [2, 1, 0]
+    assert DAL.get_note_revision(db, note_id, user_id, 2).unwrap() == "hello world from B"
+    assert DAL.get_note_revision(db, note_id, user_id, 1).unwrap() == "HELLO WORLD, edited by A"
+
+
+# BATCHED NOTE OPERATIONS
+
+
+def test_note_batch_rolls_back_a_failing_operation(db, user_id):
+    """
+    Tests that an operation failing part way through a batch leaves
+    nothing behind, while the operations around it are still applied
+    """
+    note_id = DAL.create_note_for_user(db, user_id, "start").unwrap()
+    # Make the UPDATE fail after edit_note has already written its revision
+    db.execute(
+        """
+        CREATE TRIGGER reject_boom BEFORE UPDATE ON notes
+        WHEN NEW.content = 'boom'
+        BEGIN SELECT RAISE(ABORT, 'rejected'); END
+        """
+    )
+
+    results = DAL.apply_note_batch(
+        db,
+        user_id,
+        [("edit", note_id, "boom"), ("edit", note_id, "fine"), ("create", None, "new")],
+    ).unwrap()
+
+    assert isinstance(results[0], Failure)
+    assert isinstance(results[1], Success)
+    assert isinstance(results[2], Success)
+    assert DAL.get_note_by_id(db, note_id, user_id).unwrap()[1] == "fine"
+    revisions, _ = DAL.get_note_history(db, note_id, user_id).unwrap()
+    assert len(revisions) == 2
+    latest = revisions[0][0]
+    assert DAL.get_note_revision(db, note_id, user_id, latest).unwrap() == "fine"
+
+
+# REMOTE STORAGE BACKEND
+
+
+@pytest.fixture
+def storage_address(db, tmp_path):
+    """
+    Runs a storage daemon for the test database on a unix socket,
+    and provides its address
+    """
+    address = f"unix:{tmp_path / 'storage.sock'}"
+    server = make_server(address, str(tmp_path / "database.db"), STORAGE_TOKEN)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield address
+    server.shutdown()
+    server.server_close()
+
+
+def test_wire_encoding_round_trip():
+    """
+    Tests that every type the protocol carries decodes to what was encoded
+    """
+    value = [None, 0, -(2**63), 2**63 - 1, 1.5, "", "snowman ☃", b"\x00\xff", [[1], ()]]
+    out = bytearray()
+    encode(value, out)
+    decoded, end = decode(memoryview(bytes(out)))
+    # Tuples come back as lists
+    assert decoded == value[:-1] + [[[1], []]]
+    assert end == len(out)
+    with pytest.raises(TypeError):
+        encode(object(), bytearray())
+
+
+def test_storage_server_refuses_tcp_without_token(tmp_path):
+    """
+    Tests that the storage daemon won't listen on the network without a token
+    """
+    with pytest.raises(ValueError):
+        make_server("tcp:127.0.0.1:0", str(tmp_path / "database.db"), "")
+
+
+def test_remote_connection_rejects_wrong_token(storage_address):
+    """
+    Tests that a client with the wrong token can't run anything
+    """
+    with pytest.raises(sqlite3.OperationalError):
+        RemoteConnection(storage_address, "wrong-token").execute("SELECT 1").fetchone()
+
+
+def test_remote_error_skips_pipelined_requests(db, storage_address):
+    """
+    Tests that a failed request raises the matching sqlite3 error, that requests
+    queued behind it are skipped, and that the connection works afterwards
+    """
+    remote = RemoteConnection(storage_address, STORAGE_TOKEN)
+    remote.execute("INSERT INTO missing_table VALUES (1)")
+    remote.execute("INSERT INTO users (username, password) VALUES ('skipped', 'x')")
+    with pytest.raises(sqlite3.OperationalError):
+        remote.commit()
+    assert remote.execute("SELECT COUNT(*) FROM users").fetchone() == (0,)
+
+    assert isinstance(DAL.create_user(remote, "remoteuser", "remotepassword"), Success)
+    res = DAL.create_user(remote, "remoteuser", "remotepassword")
+    assert res.failure() == "This username is already taken."
+    assert db.execute("SELECT username FROM users").fetchall() == [("remoteuser",)]
+    remote.close()
+
+
+def test_remote_pool_rolls_back_on_release(db, storage_address):
+    """
+    Tests that releasing a pooled connection rolls back its uncommitted writes
+    straight away, so it doesn't hold the write lock while idle
+    """
+    backend = RemoteBackend(storage_address, STORAGE_TOKEN)
+    remote = backend.connect()
+    remote.execute("INSERT INTO users (username, password) VALUES ('uncommitted', 'x')")
+    remote.execute("INSERT INTO missing_table VALUES (1)")
+    backend.release(remote)
+
+    # Fails with "database is locked" if the pooled connection kept its transaction
+    db.execute("INSERT INTO users (username, password) VALUES ('local', 'x')")
+    db.commit()
+    assert backend.connect() is remote
+    assert remote.execute("SELECT username FROM users").fetchall() == [("local",)]
+    backend.close()
+
+
+def test_remote_note_batch_reports_each_operation(db, user_id, storage_address):
+    """
+    Tests that over the pipelined backend a failed batch operation is reported
+    against itself, not against the operation after it
+    """
+    note_id = DAL.create_note_for_user(db, user_id, "start").unwrap()
+    db.execute(
+        """
+        CREATE TRIGGER reject_boom BEFORE UPDATE ON notes
+        WHEN NEW.content = 'boom'
+        BEGIN SELECT RAISE(ABORT, 'rejected'); END
+        """
+    )
+    db.commit()
+
+    remote = RemoteConnection(storage_address, STORAGE_TOKEN)
+    results = DAL.apply_note_batch(
+        remote, user_id, [("edit", note_id, "boom"), ("edit", note_id, "fine")]
+    ).unwrap()
+    assert isinstance(results[0], Failure)
+    assert isinstance(results[1], Success)
+    assert DAL.get_note_by_id(db, note_id, user_id).unwrap()[1] == "fine"
+    remote.close()
+
+
+# AUDIT LOG
+
+
+def read_audit_events(path):
+    """
+    Reads the events written to an audit log file.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_audit_log_rotates(tmp_path):
+    """
+    Tests that the log is rotated once it passes max_bytes, keeping at most
+    backup_count old files, with the newest events in the current one
+    """
+    path = tmp_path / "audit.log"
+    log = AuditLog()
+    log.start({"path": str(path), "max_bytes": 300, "backup_count": 2, "batch_size": 1})
+    for i in range(40):
+        log.record("test.event", number=i)
+    log.close()
+
+    assert (tmp_path / "audit.log.1").exists()
+    assert (tmp_path / "audit.log.2").exists()
+    assert not (tmp_path / "audit.log.3").exists()
+    newest = read_audit_events(path)
+    assert newest[-1]["number"] == 39
+    older = read_audit_events(tmp_path / "audit.log.1")
+    assert older[-1]["number"] == newest[0]["number"] - 1
+
+
+def test_audit_log_counts_dropped_events(tmp_path):
+    """
+    Tests that events recorded while the queue is full are dropped and counted,
+    and that the count is written once the writer catches up
+    """
+    path = tmp_path / "audit.log"
+    log = AuditLog()
+    gate = threading.Event()
+    write = log._write  # pylint: disable=protected-access
+
+    def slow_write(batch):
+        gate.wait()
+        write(batch)
+
+    log._write = slow_write  # pylint: disable=protected-access
+    log.start({"path": str(path), "queue_size": 1})
+    queued = log._queue  # pylint: disable=protected-access
+    log.record("test.event", number=0)
+    # The writer has taken the first event and is stuck writing it
+    wait_until(queued.empty)
+    for i in range(1, 4):
+        log.record("test.event", number=i)
+    gate.set()
+    log.close()
+
+    events = read_audit_events(path)
+    assert [event.get("number") for event in events if "number" in event] == [0, 1]
+    assert [event["count"] for event in events if event["event"] == "audit.dropped"] == [2]
+
+
+def test_audit_log_recovers_from_write_errors(tmp_path):
+    """
+    Tests that a failed write drops only its own batch, which is counted,
+    and that later events are written to a reopened file
+    """
+
+    class FullDisk:
+        """A log file that fails every write, like one on a full disk."""
+
+        def write(self, _data):
+            """Fails like a write to a full disk."""
+            raise OSError(28, "No space left on device")
+
+        def close(self):
+            """Closes nothing."""
+
+    path = tmp_path / "audit.log"
+    log = AuditLog()
+    log.start({"path": str(path)})
+    log._file = FullDisk()  # pylint: disable=protected-access
+    log.record("test.event", number=0)
+    wait_until(lambda: log._dropped == 1)  # pylint: disable=protected-access
+    log.record("test.event", number=1)
+    log.close()
+
+    events = read_audit_events(path)
+    assert [event["event"] for event in events] == ["test.event", "audit.dropped"]
+    assert events[0]["number"] == 1
+    assert events[1]["count"] == 1
+
+
+# BACKUPS
+
+
+def test_backup_round_trip(db, user_id, tmp_path):
+    """
+    Tests that a backup verifies, and that restoring it brings back the notes
+    it was taken with and drops the ones written since
+    """
+    config = {"dir": str(tmp_path / "backups"), "pause": 0}
+    note_id = DAL.create_note_for_user(db, user_id, "backed up").unwrap()
+    path = create_backup(db, config).unwrap()
+    assert isinstance(verify_backup(path), Success)
+    assert pick_backup(config, None).unwrap() == path
+
+    DAL.edit_note(db, note_id, user_id, "changed after the backup").unwrap()
+    DAL.create_note_for_user(db, user_id, "written after the backup").unwrap()
+
+    assert isinstance(restore_backup(str(tmp_path / "database.db"), path), Success)
+    notes = DAL.get_notes_for_user(db, user_id).unwrap()
+    assert [(row[0], row[1]) for row in notes] == [(note_id, "backed up")]
+
+
+def test_restore_rejects_a_corrupt_backup(db, user_id, tmp_path):
+    """
+    Tests that a backup not matching its checksum is refused before anything is overwritten
+    """
+    config = {"dir": str(tmp_path / "backups"), "pause": 0}
+    path = create_backup(db, config).unwrap()
+    DAL.create_note_for_user(db, user_id, "kept").unwrap()
+    with open(path, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+
+    res = restore_backup(str(tmp_path / "database.db"), path)
+    assert res.failure() == f"Checksum mismatch, {path} is corrupt."
+    assert [row[1] for row in DAL.get_notes_for_user(db, user_id).unwrap()] == ["kept"]
+    os.remove(path + ".sha256")
+    assert isinstance(verify_backup(path), Failure)
+
+
+def test_backup_errors_are_returned_as_failures(db, tmp_path):
+    """
+    Tests that a backup directory that can't be created gives a Failure, not an exception
+    """
+    (tmp_path / "not-a-directory").write_text("")
+    config = {"dir": str(tmp_path / "not-a-directory" / "backups")}
+    assert isinstance(create_backup(db, config), Failure)
+
+
+def test_backups_taken_together_are_kept_apart(db, tmp_path):
+    """
+    Tests that backups taken within the same second get their own files, that
+    backups named before timestamps had microseconds are still listed, and
+    that pruning keeps the newest
+    """
+    config = {"dir": str(tmp_path / "backups"), "keep": 2, "pause": 0}
+    os.makedirs(config["dir"])
+    legacy = tmp_path / "backups" / "backup-20250131T120000Z.db.gz"
+    legacy.write_bytes(b"")
+
+    paths = [create_backup(db, config).unwrap() for _ in range(2)]
+    assert len(set(paths)) == 2
+    assert [path for _, path in list_backups(config)] == paths
+    assert not legacy.exists()
+
+    config["keep"] = 1
+    assert prune_backups(config) == 1
+    assert [path for _, path in list_backups(config)] == paths[1:]
+
+
+# MAINTENANCE SCHEDULER
+
+
+@pytest.fixture
+def audit_events(monkeypatch):
+    """
+    Collects the audit events recorded during a test as (event, fields) pairs.
+    """
+    events = []
+    monkeypatch.setattr(
+        audit_log, "record", lambda event, **fields: events.append((event, fields))
+    )
+    return events
+
+
+def maintenance_config(tmp_path, **settings):
+    """
+    Builds a maintenance config with its files in tmp_path, where no job is due
+    for an hour and leadership is retried quickly.
+    """
+    config = {
+        "lock_path": str(tmp_path / "maintenance.lock"),
+        "activity_path": str(tmp_path / "maintenance.activity"),
+        "analyze_interval": 3600,
+        "vacuum_interval": 3600,
+        "checkpoint_interval": 3600,
+        "expire_interval": 3600,
+        "leader_retry": 0.05,
+        "quiet_period": 0,
+    }
+    config.update(settings)
+    return config
+
+
+def test_scheduler_survives_a_job_raising(tmp_path, audit_events):
+    """
+    Tests that a job raising something other than a sqlite3 error is recorded as
+    a maintenance error, and that the scheduler keeps its leadership and runs on
+    """
+    def failing_backup(_db):
+        raise NotADirectoryError("backups")
+
+    scheduler = Scheduler()
+    scheduler._backup = failing_backup  # pylint: disable=protected-access
+    scheduler.start(
+        str(tmp_path / "database.db"), maintenance_config(tmp_path), {"interval": 0.05}
+    )
+    try:
+        wait_until(lambda: len([e for e, _ in audit_events if e == "maintenance.error"]) >= 2)
+        assert scheduler._thread.is_alive()  # pylint: disable=protected-access
+    finally:
+        scheduler.stop()
+    errors = [fields for event, fields in audit_events if event == "maintenance.error"]
+    assert all(fields["job"] == "backup" for fields in errors)
+
+
+def test_scheduler_hands_over_leadership(tmp_path, audit_events):
+    """
+    Tests that only one scheduler leads at a time, and that another takes over
+    once the leader stops
+    """
+    config = maintenance_config(tmp_path)
+    first, second = Scheduler(), Scheduler()
+    first.start(str(tmp_path / "database.db"), config)
+    wait_until(lambda: first._lock_file is not None)  # pylint: disable=protected-access
+    second.start(str(tmp_path / "database.db"), config)
+    try:
+        time.sleep(0.2)
+        assert second._lock_file is None  # pylint: disable=protected-access
+        first.stop()
+        wait_until(lambda: second._lock_file is not None)  # pylint: disable=protected-access
+    finally:
+        first.stop()
+        second.stop()
+    assert [event for event, _ in audit_events] == ["maintenance.leader"] * 2
+
+
+def test_scheduler_waits_for_other_processes_traffic(tmp_path, audit_events):
+    """
+    Tests that the leader's quiet period counts requests marked by another
+    process's scheduler through the shared activity file
+    """
+    config = maintenance_config(tmp_path, quiet_period=0.3)
+    leader, other = Scheduler(), Scheduler()
+    leader.start(str(tmp_path / "database.db"), config)
+    other.start(str(tmp_path / "database.db"), config)
+    try:
+        time.sleep(0.35)
+        started = time.monotonic()
+        leader._wait_for_quiet()  # pylint: disable=protected-access
+        assert time.monotonic() - started < 0.1
+
+        other.request_started()
+        other.request_finished()
+        started = time.monotonic()
+        leader._wait_for_quiet()  # pylint: disable=protected-access
+        assert time.monotonic() - started >= 0.25
+    finally:
+        leader.stop()
+        other.stop()
+    assert audit_events.count(("maintenance.leader", {})) == 1